@@ -136,15 +136,15 @@ class Artwork:
     def library_artwork_update(self, model, start_row, end_row, albumpb):
         self.albumpb = albumpb
 
-        # Update self.lib_art_rows_local with new rows followed
-        # by the rest of the rows.
+        # Update self.lib_art_rows_local with the shown rows only: the icons
+        # of the library model are computed when they are displayed, and the
+        # other rows are updated when scrolled to.
         self.lib_art_cond.acquire()
         self.lib_art_rows_local = []
         self.lib_art_rows_remote = []
         start = start_row.get_indices()[0]
-        end = end_row.get_indices()[0]
-        test_rows = list(range(start, end + 1)) + list(range(len(model)))
-        for row in test_rows:
+        end = min(end_row.get_indices()[0], len(model) - 1)
+        for row in range(start, end + 1):
             i = model.get_iter((row,))
             icon = model.get_value(i, 0)
             if icon == self.albumpb:
@@ -15,12 +15,15 @@ self.current.current_update(prevstatus_playlist, self.status['playlistlength'])
 ...
 """
 
+import functools
 import os
 import re
+import socket
 import urllib.parse, urllib.request
 import threading # searchfilter_toggle starts thread searchfilter_loop
 
 from gi.repository import Gtk, Gdk, Pango, GLib
+import mpd
 
 from sonata import ui, misc, formatting, mpdhelper as mpdh
 
@@ -43,6 +46,8 @@ class Current:
         self.currentdata = None
         self.filterbox_visible = False
         self.current_update_skip = False
+        self.current_update_id = 0
+        self.playlist_version = None
         # Mapping between filter rows and self.currentdata rows
         self.filter_row_mapping = []
         self.columnformat = None
@@ -224,7 +229,55 @@ class Current:
 
         self.playlist_retain_view(self.current, position.y)
 
-    def current_update(self, prevstatus_playlist, new_playlist_length):
+    def current_update(self, prevstatus_playlist, new_playlist_length,
+                       playlist_version=None):
+        if not self.connected():
+            return
+        if self.current_update_skip:
+            self.current_update_songs(prevstatus_playlist, new_playlist_length,
+                                      playlist_version, None)
+        else:
+            # The changes are fetched from the MPD worker, and the view is
+            # updated once they are received. They are fetched since the
+            # playlist we display, which is older if the last changes
+            # couldn't be received.
+            if prevstatus_playlist and self.playlist_version is not None and \
+               int(self.playlist_version) < int(prevstatus_playlist):
+                prevstatus_playlist = self.playlist_version
+            self.current_update_id += 1
+            self.mpd.run_async(self.current_fetch_changes,
+                               prevstatus_playlist or 0,
+                               callback=functools.partial(
+                                   self.current_update_fetched,
+                                   self.current_update_id,
+                                   prevstatus_playlist, new_playlist_length,
+                                   playlist_version),
+                               purpose='bulk')
+
+    def current_fetch_changes(self, version):
+        # Return the songs changed since `version`, or None if they couldn't
+        # all be received
+        try:
+            return list(self.mpd.iterate('plchanges', version))
+        except (socket.error, mpd.MPDError):
+            return None
+
+    def current_update_fetched(self, update_id, prevstatus_playlist,
+                               new_playlist_length, playlist_version,
+                               changed_songs):
+        if changed_songs is None:
+            # Try again, unless another update was started meanwhile
+            if update_id == self.current_update_id:
+                GLib.timeout_add_seconds(2, self.current_update,
+                                         prevstatus_playlist,
+                                         new_playlist_length,
+                                         playlist_version)
+            return
+        self.current_update_songs(prevstatus_playlist, new_playlist_length,
+                                  playlist_version, changed_songs)
+
+    def current_update_songs(self, prevstatus_playlist, new_playlist_length,
+                             playlist_version, changed_songs):
         if self.connected():
 
             if self.sonata_loaded():
@@ -232,20 +285,19 @@ class Current:
 
             self.current.freeze_child_notify()
 
-            if not self.current_update_skip:
+            if not self.current_update_skip and changed_songs is not None:
 
                 if not self.filterbox_visible:
                     self.current.set_model(None)
 
-                if prevstatus_playlist:
-                    changed_songs = self.mpd.plchanges(prevstatus_playlist)
-                else:
-                    changed_songs = self.mpd.plchanges(0)
-                    self.current_songs = []
-
                 newlen = int(new_playlist_length)
                 currlen = len(self.currentdata)
 
+                if not prevstatus_playlist:
+                    # All the songs are sent again, and replace the rows
+                    # still in the model.
+                    self.current_songs = [None] * currlen
+
                 for track in changed_songs:
                     pos = track.pos
 
@@ -284,6 +336,9 @@ class Current:
                     self.current.set_model(self.currentdata)
 
             self.current_update_skip = False
+            # The version of MPD's playlist we display, from which we can
+            # fetch the changes after a reconnection:
+            self.playlist_version = playlist_version
 
             # Update statusbar time:
             self.total_time = sum(t.time for t in self.current_songs)
@@ -461,13 +516,10 @@ class Current:
 
             songs.sort(key=lambda x: x["sortby"])
 
-            pos = 0
-            self.mpd.command_list_ok_begin()
-            for item in songs:
-                self.mpd.moveid(item["id"], pos)
-                pos += 1
-            self.mpd.command_list_end()
-            self.iterate_now()
+            self.mpd.command_list_async(
+                [('moveid', (item["id"], pos))
+                 for pos, item in enumerate(songs)],
+                callback=lambda _result: self.iterate_now())
 
             self.header_update_column_indicators()
 
@@ -496,17 +548,15 @@ class Current:
         if self.connected():
             if not self.currentdata:
                 return
-            while Gtk.events_pending():
-                Gtk.main_iteration()
             top = 0
             bot = len(self.currentdata)-1
-            self.mpd.command_list_ok_begin()
+            commands = []
             while top < bot:
-                self.mpd.swap(top, bot)
+                commands.append(('swap', (top, bot)))
                 top = top + 1
                 bot = bot - 1
-            self.mpd.command_list_end()
-            self.iterate_now()
+            self.mpd.command_list_async(
+                commands, callback=lambda _result: self.iterate_now())
 
     def on_dnd(self, treeview, drag_context, x, y, selection, _info,
                timestamp):
@@ -538,10 +588,10 @@ class Current:
                         if 'file' in item:
                             mpdpaths.append(item['file'])
 
-                # Add local file, available in mpd 0.14. This currently
-                # work because python-mpd does not support unix socket
-                # paths, won't which is needed for authentication for
-                # local files. It's also therefore untested.
+                # Add local file, available in mpd 0.14. MPD only allows
+                # this to clients connected through its unix socket.
+                if not self.mpd.uses_unix_socket:
+                    continue
                 if os.path.isdir(paths[i]):
                     filenames = misc.get_files_recursively(paths[i])
                 else:
@@ -560,9 +610,9 @@ class Current:
                         songid = destpath[0] + 1
                 else:
                     songid = len(self.currentdata)
-                for mpdpath in mpdpaths:
-                    self.mpd.addid(mpdpath, songid)
-            self.iterate_now()
+                self.mpd.command_list_async(
+                    [('addid', (mpdpath, songid)) for mpdpath in mpdpaths],
+                    callback=lambda _result: self.iterate_now())
             return
 
         # Otherwise, it's a DND just within the current playlist
@@ -584,7 +634,7 @@ class Current:
         # We will manipulate self.current_songs and model to prevent
         # the entire playlist from refreshing
         offset = 0
-        self.mpd.command_list_ok_begin()
+        commands = []
         for source in drag_sources:
             index, i, songid, text = source
             if drop_info:
@@ -597,10 +647,10 @@ class Current:
                     self.current_songs.insert(dest, self.current_songs[index])
                     if dest < index + 1:
                         self.current_songs.pop(index + 1)
-                        self.mpd.moveid(songid, dest)
+                        commands.append(('moveid', (songid, dest)))
                     else:
                         self.current_songs.pop(index)
-                        self.mpd.moveid(songid, dest - 1)
+                        commands.append(('moveid', (songid, dest - 1)))
                     model.insert(dest, model[index])
                     moved_iters += [model.get_iter((dest,))]
                     model.remove(i)
@@ -609,17 +659,17 @@ class Current:
                                               self.current_songs[index])
                     if dest < index:
                         self.current_songs.pop(index + 1)
-                        self.mpd.moveid(songid, dest + 1)
+                        commands.append(('moveid', (songid, dest + 1)))
                     else:
                         self.current_songs.pop(index)
-                        self.mpd.moveid(songid, dest)
+                        commands.append(('moveid', (songid, dest)))
                     model.insert(dest + 1, model[index])
                     moved_iters += [model.get_iter((dest + 1,))]
                     model.remove(i)
             else:
                 #dest = int(self.status['playlistlength']) - 1
                 dest = len(self.currentdata) - 1
-                self.mpd.moveid(songid, dest)
+                commands.append(('moveid', (songid, dest)))
                 self.current_songs.insert(dest + 1, self.current_songs[index])
                 self.current_songs.pop(index)
                 model.insert(dest + 1, model[index])
@@ -636,7 +686,7 @@ class Current:
                     # decreased by 1
                     if index < source[0] < dest:
                         source[0] -= 1
-        self.mpd.command_list_end()
+        self.mpd.command_list_async(commands)
 
         # we are manipulating the model manually for speed, so...
         self.current_update_skip = True
@@ -661,7 +711,7 @@ class Current:
             return
         try:
             i = model.get_iter(path)
-            self.mpd.playid(self.current_get_songid(i, model))
+            self.mpd.call_async('playid', self.current_get_songid(i, model))
         except:
             pass
         self.sel_rows = False
@@ -705,7 +755,7 @@ class Current:
             song_id = self.current_get_songid(model.get_iter_first(), model)
         if song_id:
             self.searchfilter_toggle(None)
-            self.mpd.playid(song_id)
+            self.mpd.call_async('playid', song_id)
 
     def searchfilter_feed_loop(self, editable):
         # Lets only trigger the searchfilter_loop if 200ms pass
@@ -900,7 +950,7 @@ class Current:
         if len(selected) == len(self.currentdata) and \
            not self.filterbox_visible:
             # Everything is selected, clear:
-            self.mpd.clear()
+            self.mpd.call_async('clear')
         elif len(selected) > 0:
             # we are manipulating the model manually for speed, so...
             self.current_update_skip = True
@@ -909,18 +959,19 @@ class Current:
                 # If we remove an item from the filtered results, this
                 # causes a visual refresh in the interface.
                 self.current.set_model(None)
-            self.mpd.command_list_ok_begin()
+            commands = []
             for path in selected:
                 if not self.filterbox_visible:
                     rownum = path.get_indices()[0]
                 else:
                     rownum = self.filter_row_mapping[path.get_indices()[0]]
                 i = self.currentdata.get_iter((rownum, 0))
-                self.mpd.deleteid(
-                    self.current_get_songid(i, self.currentdata))
+                commands.append(
+                    ('deleteid',
+                     (self.current_get_songid(i, self.currentdata),)))
                 # Prevents the entire playlist from refreshing:
                 self.current_songs.pop(rownum)
                 self.currentdata.remove(i)
-            self.mpd.command_list_end()
+            self.mpd.command_list_async(commands)
             if not self.filterbox_visible:
                 self.current.set_model(model)
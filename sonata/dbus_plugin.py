@@ -5,6 +5,7 @@ This plugin implements D-Bus features for Sonata:
  * Check that only one instance of Sonata is running at a time
  * Allow other programs to request the info popup, and to show or to toggle
    the main window visibility
+ * Give access to the statistics about the commands sent to MPD
  * Listen to Gnome 2.18+ multimedia key events
 
 XXX Not a real plugin yet.
@@ -22,6 +23,8 @@ if not dbus.using_gnome_mediakeys():
 import logging
 import sys
 
+from sonata import mpdhelper
+
 try:
     import dbus
     import dbus.service
@@ -156,3 +159,11 @@ if HAVE_DBUS:
         @dbus.service.method('org.MPD.SonataInterface')
         def fullscreen(self):
             self.dbus_fullscreen()
+
+        @dbus.service.method('org.MPD.SonataInterface', out_signature='s')
+        def mpd_metrics(self):
+            return mpdhelper.metrics.dump()
+
+        @dbus.service.method('org.MPD.SonataInterface')
+        def mpd_metrics_reset(self):
+            mpdhelper.metrics.reset()
@@ -183,6 +183,8 @@ def run():
     # so you can debug while you run it.
     if args.start_shell:
         # the enviroment used for the shell
+        # mpd_metrics.dump() shows statistics about the commands sent to MPD
+        from sonata.mpdhelper import metrics as mpd_metrics
         scope = dict(list(globals().items()) + list(locals().items()))
         def run_shell():
             try:
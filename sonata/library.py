@@ -2,43 +2,111 @@ import os
 import re
 import gettext
 import locale
+import socket
 import threading # libsearchfilter_toggle starts thread libsearchfilter_loop
+import time
+import functools
+import collections
+import itertools
 import operator
 
-from gi.repository import Gtk, Gdk, GdkPixbuf, GObject, GLib, Pango
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, Pango
+import mpd
 
 from sonata import ui, misc, consts, formatting, breadcrumbs, mpdhelper as mpdh
 from sonata.song import SongRecord
+from sonata.libraryindex import LibraryIndex, fold, search_rank
+from sonata.librarymodel import LibraryModel
 
 
 VARIOUS_ARTISTS = _("Various Artists")
 
+# Number of rows added to the library view at once: the first chunk is shown
+# right away, and should fill the window.
+POPULATE_CHUNK_SIZE = 500
+
+# Rough memory used by a row of a library view, to bound the size of the cache
+# of views
+ROW_SIZE = 512
+
+# Seconds to wait before scanning the same database again after a failed
+# scan of the library index, doubled after each failure
+INDEX_RETRY_DELAY_MIN = 60
+INDEX_RETRY_DELAY_MAX = 3600
+
 
 def list_mark_various_artists_albums(albums):
-    for i in range(len(albums)):
-        if i + consts.NUM_ARTISTS_FOR_VA - 1 > len(albums)-1:
-            break
-        VA = False
-        for j in range(1, consts.NUM_ARTISTS_FOR_VA):
-            if albums[i].album.lower() != albums[i + j].album.lower() or \
-               albums[i].year  != albums[i + j].year or \
-               albums[i].path  != albums[i + j].path:
-                break
-            if albums[i].artist == albums[i + j].artist:
-                albums.pop(i + j)
-                break
-            if j == consts.NUM_ARTISTS_FOR_VA - 1:
-                VA = True
-        if VA:
-            albums[i].artist = VARIOUS_ARTISTS
-            j = 1
-            while i + j <= len(albums) - 1:
-                if albums[i].album.lower() == albums[i + j].album.lower() \
-                   and albums[i].year == albums[i + j].year:
-                    albums.pop(i + j)
-                else:
-                    break
-    return albums
+    """Return `albums` with one row per album, its artist being
+    VARIOUS_ARTISTS if it has at least NUM_ARTISTS_FOR_VA different artists.
+
+    Rows are of the same album when their album, year and path are equal,
+    regardless of case, and of the same artist likewise: `albums` doesn't
+    need to be sorted or without duplicates. The first row of each album and
+    artist is kept, in the order of `albums`. Rows without a path are never
+    merged with the ones of other artists, since same-named albums can't be
+    told apart then: see Library.library_albums_set_paths().
+    """
+    groups = collections.OrderedDict()
+    for item in albums:
+        key = (fold(item.album or ''), fold(item.year or ''), item.path)
+        if item.path is None:
+            key += (fold(item.artist or ''),)
+        artists = groups.setdefault(key, collections.OrderedDict())
+        artists.setdefault(fold(item.artist or ''), item)
+    result = []
+    for artists in groups.values():
+        if len(artists) >= consts.NUM_ARTISTS_FOR_VA:
+            first = next(iter(artists.values()))
+            result.append(SongRecord(album=first.album,
+                                     artist=VARIOUS_ARTISTS,
+                                     genre=first.genre, year=first.year,
+                                     path=first.path))
+        else:
+            result.extend(artists.values())
+    return result
+
+
+def remove_covered_rows(rows):
+    """Return the (is_file, data) library `rows` without the ones whose
+    songs are those of another row too: the files and directories within a
+    selected directory, and the rows matching the tags of another one (an
+    album of a selected artist, the albums of a Various Artists album...).
+    Tags are compared regardless of case, like MPD does. Of identical rows,
+    the first one is kept.
+    """
+    def row_tags(data):
+        tags = {'genre': data.genre, 'album': data.album, 'year': data.year}
+        if data.artist != VARIOUS_ARTISTS:
+            tags['artist'] = data.artist
+        return frozenset((tag, fold(value)) for tag, value in tags.items()
+                         if value is not None)
+
+    directories = set(data.path for is_file, data in rows
+                      if not is_file and data.path is not None)
+    tag_rows = set(row_tags(data) for _is_file, data in rows)
+    seen = set()
+    result = []
+    for is_file, data in rows:
+        tags = row_tags(data)
+        if tags:
+            key = tags
+            # Whether another row matches a part of the tags of this one
+            covered = any(frozenset(part) in tag_rows
+                          for size in range(1, len(tags))
+                          for part in itertools.combinations(tags, size))
+        elif data.path is not None:
+            key = data.path
+            parent = os.path.dirname(data.path)
+            covered = False
+            while parent and not covered:
+                covered = parent in directories
+                parent = os.path.dirname(parent)
+        else:
+            continue
+        if not covered and key not in seen:
+            seen.add(key)
+            result.append((is_file, data))
+    return result
 
 
 class Library:
@@ -74,16 +142,27 @@ class Library:
         self.prevlibtodo = None
 
         self.save_timeout = None
+        self.library_browse_id = 0
+        self.library_populate_source = None
         self.libsearch_last_tooltip = None
 
-        self.lib_view_filesystem_cache = None
-        self.lib_view_artist_cache = None
-        self.lib_view_genre_cache = None
-        self.lib_view_album_cache = None
+        # (lib_view, wd) -> (wd, rows) of the views built for the current
+        # database, see library_populate_wd() and library_views_reset()
+        self.library_views = mpdh.ResultCache(max_entries=200,
+                                              max_bytes=64 * 1024 * 1024)
         self.lib_list_genres = None
         self.lib_list_artists = None
         self.lib_list_albums = None
         self.lib_list_years = None
+        self.library_index = None
+        self.library_index_file = None
+        self.library_index_id = 0
+        self.library_index_valid = None
+        self.library_views_reset()
+        self.library_index_building = None
+        # (index id, time) before which a failed scan isn't tried again
+        self.library_index_retry = None
+        self.library_index_failures = 0
         self.view_caches_reset()
 
         # Library tab
@@ -169,8 +248,7 @@ class Library:
         self.searchcombo.handler_block(searchcombo_changed_handler)
         self.searchcombo.set_active(self.config.last_search_num)
         self.searchcombo.handler_unblock(searchcombo_changed_handler)
-        self.librarydata = Gtk.ListStore(GdkPixbuf.Pixbuf,
-                                         GObject.TYPE_PYOBJECT, str)
+        self.librarydata = LibraryModel()
         self.library.set_model(self.librarydata)
         self.library.set_search_column(2)
         self.librarycell = Gtk.CellRendererText()
@@ -181,7 +259,10 @@ class Library:
         self.librarycolumn.pack_start(self.librarycell, True)
         self.librarycolumn.add_attribute(self.libraryimg, 'pixbuf', 0)
         self.librarycolumn.add_attribute(self.librarycell, 'markup', 2)
-        self.librarycolumn.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
+        # Autosizing would compute the markup of every row. The rows are
+        # also measured once when they are alike, see library_set_rows().
+        self.librarycolumn.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        self.librarycolumn.set_expand(True)
         self.library.append_column(self.librarycolumn)
         self.library_selection.set_mode(Gtk.SelectionMode.MULTIPLE)
 
@@ -245,14 +326,165 @@ class Library:
     def view_caches_reset(self):
         # We should call this on first load and whenever mpd is
         # updated.
-        self.lib_view_filesystem_cache = None
-        self.lib_view_artist_cache = None
-        self.lib_view_genre_cache = None
-        self.lib_view_album_cache = None
         self.lib_list_genres = None
         self.lib_list_artists = None
         self.lib_list_albums = None
         self.lib_list_years = None
+        # The index is kept, but must be checked against the database before
+        # being used again.
+        self.library_index_id += 1
+        self.library_views_reset()
+
+    def library_views_reset(self):
+        # The views differ once built from the index (albums are grouped
+        # and marked as Various Artists from their songs), so the ones
+        # built from MPD meanwhile are dropped when it's ready.
+        self.library_views.set_version((self.library_index_id,
+                                        self.library_index_get() is not None))
+
+    def library_index_get(self):
+        # Return the index, if it is known to be up to date
+        if self.library_index_valid == self.library_index_id:
+            return self.library_index
+        return None
+
+    def library_index_filename(self):
+        # One index per server
+        host, port = self.mpd.address
+        name = re.sub(r'[^\w.-]', '_', '%s_%s' % (host, port))
+        return os.path.expanduser('~/.config/sonata/library/%s' % name)
+
+    def library_index_wanted(self):
+        # Whether the index should be built now. A database which failed to
+        # be scanned is only scanned again after a while, or once changed.
+        if self.library_index_get() is not None or \
+           self.library_index_building == self.library_index_id:
+            return False
+        if self.library_index_retry is None:
+            return True
+        index_id, retry_time = self.library_index_retry
+        return index_id != self.library_index_id or \
+                time.monotonic() >= retry_time
+
+    def library_index_update(self):
+        # Scan the database from the bulk connection, one directory at a
+        # time: the commands queued meanwhile, by the views or the user, are
+        # sent between two directories rather than after the whole scan.
+        self.library_index_building = self.library_index_id
+        self.library_index_step(self.library_index_id, None)
+
+    def library_index_step(self, index_id, scan):
+        future = self.mpd.run_async(
+            self.library_index_build, index_id, scan, purpose='bulk',
+            callback=functools.partial(self.library_index_scanned, index_id))
+        future.add_done_callback(
+            functools.partial(self.library_index_failed, index_id))
+
+    def library_index_scanned(self, index_id, scan):
+        if scan is not None:
+            self.library_index_step(index_id, scan)
+        elif index_id == self.library_index_valid:
+            self.library_views_reset()
+
+    def library_index_failed(self, index_id, future):
+        # Called from the worker; without this, the index would never be
+        # built again during the session.
+        if future.cancelled() or future.exception() is not None:
+            self.library_index_scan_failed(index_id)
+
+    def library_index_scan_failed(self, index_id):
+        if index_id == self.library_index_building:
+            self.library_index_building = None
+        delay = min(INDEX_RETRY_DELAY_MIN * 2 ** self.library_index_failures,
+                    INDEX_RETRY_DELAY_MAX)
+        self.library_index_failures += 1
+        self.library_index_retry = (index_id, time.monotonic() + delay)
+
+    def library_index_build(self, index_id, scan):
+        # Run a step of the build, and return the state of the scan to pass
+        # to the next one, or None once done.
+        if index_id != self.library_index_id:
+            # The database changed meanwhile, another build will be needed
+            scan = None
+            index = None
+        elif scan is None:
+            stats = self.mpd.stats()
+            version = stats.get('db_update')
+            filename = self.library_index_filename()
+            index = self.library_index
+            if self.library_index_file != filename:
+                index = LibraryIndex.load(filename, self.NOTAG,
+                                          VARIOUS_ARTISTS)
+            if version is None:
+                index = None
+            elif index is not None and index.version != version:
+                if self.library_index_refresh(index, stats):
+                    index.update((), version=version)
+                    index.save(filename)
+                else:
+                    index = None
+            if index is None and version is not None:
+                items = self.mpd.lsinfo('/')
+                directories = [item['directory'] for item in items
+                               if 'directory' in item]
+                songs = [mpdh.MPDSong(item) for item in items
+                         if 'file' in item]
+                return (version, int(stats.get('songs', -1)), filename,
+                        directories, songs)
+        else:
+            version, num_songs, filename, directories, songs = scan
+            if directories:
+                songs.extend(self.mpd.iterate('listallinfo',
+                                              directories.pop()))
+            if directories:
+                return scan
+            index = LibraryIndex(songs, version, self.NOTAG, VARIOUS_ARTISTS)
+            if len(index) == num_songs:
+                misc.create_dir(os.path.dirname(filename))
+                index.save(filename)
+            else:
+                # The scan failed or the database changed meanwhile, keep on
+                # querying MPD until the next try.
+                index = None
+                self.library_index_scan_failed(index_id)
+        if index is not None and index_id == self.library_index_id:
+            self.library_index = index
+            self.library_index_file = filename
+            self.library_index_valid = index_id
+            self.library_index_retry = None
+            self.library_index_failures = 0
+        if index_id == self.library_index_building:
+            self.library_index_building = None
+        return None
+
+    def library_index_refresh(self, index, stats):
+        # Bring the index up to date with only the songs which changed since
+        # it was built, and return whether it worked. Tagging files doesn't
+        # change their directory, so modified songs are found from their own
+        # modification time, and added or removed ones from the list of
+        # files, which is much smaller than the whole database.
+        # Failed commands return None: the index is then scanned again.
+        items = self.mpd.listall('/')
+        if items is None:
+            return False
+        files = set(item['file'] for item in items if 'file' in item)
+        if not files:
+            return False
+        modified = self.mpd.find('modified-since', index.version)
+        if modified is None:
+            return False
+        known = set(song.file for song in index.songs)
+        songs = [mpdh.MPDSong(item) for item in modified]
+        # Files copied with their modification time are only found in the
+        # list, so their directories are read again.
+        directories = set(os.path.dirname(f)
+                          for f in files - known - set(s.file for s in songs))
+        with self.mpd.batch() as batch:
+            futures = [batch.lsinfo(directory) for directory in directories]
+        songs += [mpdh.MPDSong(item) for future in futures
+                  for item in future.result() or [] if 'file' in item]
+        index.update(songs, known - files)
+        return len(index) == int(stats.get('songs', -1))
 
     def on_library_scrolled(self, _widget, _event):
         try:
@@ -277,6 +509,41 @@ class Library:
         else:
             start_row, end_row = visible_range
 
+        # The path of albums, needed to find their cover, may not be known
+        # yet: find the ones of the visible rows first.
+        rows = []
+        for row in range(start_row.get_indices()[0],
+                         end_row.get_indices()[0] + 1):
+            data = self.librarydata.get_value(
+                self.librarydata.get_iter((row,)), 1)
+            if data.album not in (None, self.NOTAG) and data.path is None:
+                rows.append((row, data))
+        if rows:
+            self.mpd.run_async(self.library_album_paths,
+                               [data for _row, data in rows],
+                               callback=functools.partial(
+                                   self.library_album_paths_found,
+                                   self.library_browse_id, rows, start_row,
+                                   end_row),
+                               purpose='bulk')
+            return
+
+        self.artwork.library_artwork_update(self.librarydata, start_row,
+                                            end_row, self.albumpb)
+
+    def library_album_paths_found(self, browse_id, rows, start_row, end_row,
+                                  paths):
+        if browse_id != self.library_browse_id:
+            return
+        for (row, data), path in zip(rows, paths):
+            # SongRecords are hashable, so they are replaced rather than
+            # modified. The rows of the model are the ones of the cached
+            # view, so the view is updated too.
+            new_data = SongRecord(artist=data.artist, album=data.album,
+                                  year=data.year, path=path or '')
+            i = self.librarydata.get_iter((row,))
+            if self.librarydata.get_value(i, 1) is data:
+                self.librarydata.set_value(i, 1, new_data)
         self.artwork.library_artwork_update(self.librarydata, start_row,
                                             end_row, self.albumpb)
 
@@ -342,32 +609,58 @@ class Library:
             self.save_timeout = GLib.timeout_add(5000, self.settings_save)
 
         self.config.wd = root
-        self.library.freeze_child_notify()
-        self.librarydata.clear()
-
-        # Populate treeview with data:
+        if self.library_index_wanted():
+            self.library_index_update()
+        # Query MPD from the worker, and fill the view once done. If another
+        # directory is browsed meanwhile, the result is dropped.
+        # The view and the version of the database are the ones the rows
+        # are cached for, and must still be current once they're read.
+        self.library_browse_id += 1
+        key = (self.config.lib_view, root, self.library_views.version)
+        self.mpd.run_async(self.library_populate_wd, key,
+                           callback=functools.partial(self.library_browse_done,
+                                                      self.library_browse_id,
+                                                      key,
+                                                      path_updated,
+                                                      prev_selection,
+                                                      prev_selection_root,
+                                                      prev_selection_parent),
+                           purpose='bulk')
+
+    def library_populate_wd(self, key):
+        # Return the rows to display for the level `key` (lib_view, wd,
+        # version), along with the directory they belong to. The last views
+        # are kept until the database changes, so that going back and forth
+        # between levels doesn't query MPD again; library_browse_done() adds
+        # them to the cache.
+        lib_view, wd, _version = key
+        result = self.library_views.get((lib_view, wd))
+        if result is None:
+            result = self.library_populate_wd_uncached(lib_view, wd)
+        return result
+
+    def library_populate_wd_uncached(self, lib_view, wd):
         bd = []
-        wd = self.config.wd
         while len(bd) == 0:
-            if self.config.lib_view == consts.VIEW_FILESYSTEM:
+            if lib_view == consts.VIEW_FILESYSTEM:
                 bd = self.library_populate_filesystem_data(wd.path)
-            elif self.config.lib_view == consts.VIEW_ALBUM:
+            elif lib_view == consts.VIEW_ALBUM:
                 if wd.album is not None:
                     bd = self.library_populate_data(artist=wd.artist,
                                                     album=wd.album,
                                                     year=wd.year)
                 else:
                     bd = self.library_populate_toplevel_data(albumview=True)
-            elif self.config.lib_view == consts.VIEW_ARTIST:
+            elif lib_view == consts.VIEW_ARTIST:
                 if wd.artist is not None and wd.album is not None:
                     bd = self.library_populate_data(artist=wd.artist,
                                                     album=wd.album,
                                                     year=wd.year)
-                elif self.config.wd.artist is not None:
+                elif wd.artist is not None:
                     bd = self.library_populate_data(artist=wd.artist)
                 else:
                     bd = self.library_populate_toplevel_data(artistview=True)
-            elif self.config.lib_view == consts.VIEW_GENRE:
+            elif lib_view == consts.VIEW_GENRE:
                 if wd.genre is not None and \
                    wd.artist is not None and \
                    wd.album is not None:
@@ -384,18 +677,54 @@ class Library:
             if len(bd) == 0:
                 # Nothing found; go up a level until we reach the top level
                 # or results are found
-                last_wd = self.config.wd
-                self.config.wd = self.library_get_parent()
-                if self.config.wd == last_wd:
+                last_wd = wd
+                wd = self.library_get_parent(wd, lib_view)
+                if wd == last_wd:
                     break
+        return wd, bd
 
-        for _sort, path in bd:
-            self.librarydata.append(path)
+    def library_browse_done(self, browse_id, key, path_updated, prev_selection,
+                            prev_selection_root, prev_selection_parent,
+                            result):
+        if browse_id != self.library_browse_id:
+            return
+        lib_view, wd, version = key
+        if lib_view == self.config.lib_view and \
+           version == self.library_views.version:
+            self.library_views.put((lib_view, wd), result,
+                                   len(result[1]) * ROW_SIZE)
+        self.config.wd, bd = result
 
-        self.library.thaw_child_notify()
+        # Populate treeview with data:
+        self.library_set_rows([row for _sort, row in bd],
+                              functools.partial(self.library_populate_done,
+                                                path_updated, prev_selection,
+                                                prev_selection_root,
+                                                prev_selection_parent))
 
-        # Scroll back to set view for current dir:
+        # Update library artwork as necessary
         self.library.realize()
+        self.on_library_scrolled(None, None)
+
+        self.update_breadcrumbs()
+
+    def library_populate_chunk(self, wd, rows, done):
+        start = len(self.librarydata)
+        if wd != self.config.wd or start == 0:
+            # Browsed elsewhere, or the view was cleared
+            self.library_populate_source = None
+            return False
+        self.librarydata.extend(rows[start:start + POPULATE_CHUNK_SIZE])
+        if len(self.librarydata) < len(rows):
+            return True
+        self.library_populate_source = None
+        if done is not None:
+            done()
+        return False
+
+    def library_populate_done(self, path_updated, prev_selection,
+                              prev_selection_root, prev_selection_parent):
+        # Scroll back to set view for current dir:
         GLib.idle_add(self.library_set_view, not path_updated)
         if len(prev_selection) > 0 or prev_selection_root or \
            prev_selection_parent:
@@ -403,10 +732,31 @@ class Library:
             self.library_retain_selection(prev_selection, prev_selection_root,
                                           prev_selection_parent)
 
-        # Update library artwork as necessary
-        self.on_library_scrolled(None, None)
-
-        self.update_breadcrumbs()
+    def library_set_rows(self, rows, done=None):
+        # Only the first rows are shown now, so that big views don't block
+        # the main loop: the others follow in chunks, until the rows are set
+        # again or another directory is browsed. done() is called once they
+        # are all shown.
+        if self.library_populate_source is not None:
+            GLib.source_remove(self.library_populate_source)
+            self.library_populate_source = None
+        # Swapping the rows while the view is detached is much faster than
+        # signaling each of them
+        self.library.set_model(None)
+        # In fixed height mode, all the rows get the height of the first
+        # one. Rows with the same icon come from the same function, and have
+        # the same number of lines; album artwork may differ in size.
+        icons = set(id(row[0]) for row in rows)
+        self.library.set_fixed_height_mode(
+            len(icons) == 1 and not callable(rows[0][0]))
+        self.librarydata.set_rows(rows[:POPULATE_CHUNK_SIZE])
+        self.library.set_model(self.librarydata)
+        self.library.set_search_column(2)
+        if len(rows) > POPULATE_CHUNK_SIZE:
+            self.library_populate_source = GLib.idle_add(
+                self.library_populate_chunk, self.config.wd, rows, done)
+        elif done is not None:
+            done()
 
     def update_breadcrumbs(self):
         # remove previous buttons
@@ -511,52 +861,23 @@ class Library:
     def library_populate_filesystem_data(self, path):
         # List all dirs/files at path
         bd = []
-        if path == '/' and self.lib_view_filesystem_cache is not None:
-            # Use cache if possible...
-            bd = self.lib_view_filesystem_cache
-        else:
-            for item in self.mpd.lsinfo(path):
-                if 'directory' in item:
-                    name = os.path.basename(item['directory'])
-                    data = SongRecord(path=item["directory"])
-                    bd += [('d' + str(name).lower(), [self.openpb, data,
-                                                      misc.escape_html(name)])]
-                elif 'file' in item:
-                    data = SongRecord(path=item['file'])
-                    bd += [('f' + item['file'].lower(),
-                            [self.sonatapb, data,
-                             formatting.parse(self.config.libraryformat, item,
-                                              True)])]
-            bd.sort(key=operator.itemgetter(0))
-        return bd
-
-    def library_get_toplevel_cache(self, genreview=False, artistview=False,
-                                   albumview=False):
-        if genreview and self.lib_view_genre_cache is not None:
-            bd = self.lib_view_genre_cache
-        elif artistview and self.lib_view_artist_cache is not None:
-            bd = self.lib_view_artist_cache
-        elif albumview and self.lib_view_album_cache is not None:
-            bd = self.lib_view_album_cache
-        else:
-            return None
-        # Check if we can update any artwork:
-        for _sort, info in bd:
-            pb = info[0]
-            if pb == self.albumpb:
-                key = SongRecord(path=info[1].path, artist=info[1].artist,
-                                 album=info[1].album)
-                pb2 = self.artwork.get_library_artwork_cached_pb(key, None)
-                if pb2 is not None:
-                    info[0] = pb2
+        for item in self.mpd.lsinfo(path):
+            if 'directory' in item:
+                name = os.path.basename(item['directory'])
+                data = SongRecord(path=item["directory"])
+                bd += [('d' + str(name).lower(), [self.openpb, data,
+                                                  misc.escape_html(name)])]
+            elif 'file' in item:
+                data = SongRecord(path=item['file'])
+                bd += [('f' + item['file'].lower(),
+                        [self.sonatapb, data,
+                         functools.partial(self.library_song_markup,
+                                           item)])]
+        bd.sort(key=operator.itemgetter(0))
         return bd
 
     def library_populate_toplevel_data(self, genreview=False, artistview=False,
                                        albumview=False):
-        bd = self.library_get_toplevel_cache(genreview, artistview, albumview)
-        if bd is not None:
-            # We have our cached data, woot.
-            return bd
         bd = []
         if genreview or artistview:
             # Only for artist/genre views, album view is handled differently
@@ -569,28 +890,45 @@ class Library:
                 pb = self.artistpb
             if not (self.NOTAG in items):
                 items.append(self.NOTAG)
-            for item in items:
-                if genreview:
-                    playtime, num_songs = self.library_return_count(genre=item)
-                    data = SongRecord(genre=item)
-                else:
-                    playtime, num_songs = self.library_return_count(
-                        artist=item)
-                    data = SongRecord(artist=item)
+            if genreview:
+                queries = [{'genre': item} for item in items]
+            else:
+                queries = [{'artist': item} for item in items]
+            counts = self.library_return_grouped_counts(
+                'genre' if genreview else 'artist', queries)
+            for item, query, (playtime, num_songs) in zip(items, queries,
+                                                          counts):
+                data = SongRecord(**query)
                 if num_songs > 0:
-                    display = misc.escape_html(item)
-                    display += self.add_display_info(num_songs, playtime)
+                    display = functools.partial(self.library_row_markup, item,
+                                                num_songs, playtime)
                     bd += [(misc.lower_no_the(item), [pb, data, display])]
         elif albumview:
             albums = []
             untagged_found = False
-            for item in self.mpd.listallinfo('/'):
-                if 'file' in item and 'album' in item:
+            index = self.library_index_get()
+            if index is not None:
+                items = index.songs
+            elif self.mpd.version >= (0, 21):
+                # One line per album, their path is found once displayed
+                items = self.mpd.list('album', 'group', 'artist',
+                                      'group', 'date')
+                if not items or not isinstance(items[0], dict):
+                    # Older python-mpd2 versions only return the album
+                    # names, without the groups.
+                    items = self.mpd.iterate('listallinfo', '/')
+            else:
+                items = self.mpd.iterate('listallinfo', '/')
+            for item in items:
+                if item.get('album'):
                     album = item['album']
-                    artist = item.get('artist', self.NOTAG)
-                    year = item.get('date', self.NOTAG)
-                    path = self.get_multicd_album_root_dir(
-                        os.path.dirname(item['file']))
+                    artist = item.get('artist') or self.NOTAG
+                    year = item.get('date') or self.NOTAG
+                    if 'file' in item:
+                        path = self.get_multicd_album_root_dir(
+                            os.path.dirname(item['file']))
+                    else:
+                        path = None
                     data = SongRecord(album=album, artist=artist,
                                       year=year, path=path)
                     albums.append(data)
@@ -598,38 +936,19 @@ class Library:
                         untagged_found = True
             if not untagged_found:
                 albums.append(SongRecord(album=self.NOTAG))
-            albums = misc.remove_list_duplicates(albums, case=False)
+            self.library_albums_set_paths(albums)
             albums = list_mark_various_artists_albums(albums)
-            for item in albums:
+            counts = self.library_return_album_counts(albums)
+            for item, (playtime, num_songs) in zip(albums, counts):
                 album, artist, _genre, year, path = item
-                playtime, num_songs = self.library_return_count(artist=artist,
-                                                                album=album,
-                                                                year=year)
                 if num_songs > 0:
                     data = SongRecord(artist=artist, album=album,
                                            year=year, path=path)
-                    display = misc.escape_html(album)
-                    if artist and year and len(artist) > 0 and len(year) > 0 \
-                       and artist != self.NOTAG and year != self.NOTAG:
-                        display += " <span weight='light'>(%s, %s)</span>" \
-                                % (misc.escape_html(artist),
-                                   misc.escape_html(year))
-                    elif artist and len(artist) > 0 and artist != self.NOTAG:
-                        display += " <span weight='light'>(%s)</span>" \
-                                % misc.escape_html(artist)
-                    elif year and len(year) > 0 and year != self.NOTAG:
-                        display += " <span weight='light'>(%s)</span>" \
-                                % misc.escape_html(year)
-                    display += self.add_display_info(num_songs, playtime)
-                    bd += [(misc.lower_no_the(album), [self.albumpb, data,
-                                                       display])]
+                    display = functools.partial(self.library_album_markup,
+                                                True, num_songs, playtime)
+                    bd += [(misc.lower_no_the(album),
+                            [self.library_album_pixbuf, data, display])]
         bd.sort(key=lambda key: locale.strxfrm(key[0]))
-        if genreview:
-            self.lib_view_genre_cache = bd
-        elif artistview:
-            self.lib_view_artist_cache = bd
-        elif albumview:
-            self.lib_view_album_cache = bd
         return bd
 
 
@@ -643,12 +962,14 @@ class Library:
             if len(artists) > 0:
                 if not self.NOTAG in artists:
                     artists.append(self.NOTAG)
-                for artist in artists:
-                    playtime, num_songs = self.library_return_count(
-                        genre=genre, artist=artist)
+                counts = self.library_return_grouped_counts(
+                    'artist', [{'genre': genre, 'artist': artist}
+                               for artist in artists], genre=genre)
+                for artist, (playtime, num_songs) in zip(artists, counts):
                     if num_songs > 0:
-                        display = misc.escape_html(artist)
-                        display += self.add_display_info(num_songs, playtime)
+                        display = functools.partial(self.library_row_markup,
+                                                    artist, num_songs,
+                                                    playtime)
                         data = SongRecord(genre=genre, artist=artist)
                         bd += [(misc.lower_no_the(artist),
                                 [self.artistpb, data, display])]
@@ -660,53 +981,29 @@ class Library:
                                                         artist=artist)
             else:
                 albums = self.library_return_list_items('album', artist=artist)
+            queries = []
             for album in albums:
-                if genre is not None:
-                    years = self.library_return_list_items('date', genre=genre,
-                                                           artist=artist,
-                                                           album=album)
-                else:
-                    years = self.library_return_list_items('date',
-                                                           artist=artist,
-                                                           album=album)
+                years = self.library_return_list_items('date', genre=genre,
+                                                       artist=artist,
+                                                       album=album)
                 if not self.NOTAG in years:
                     years.append(self.NOTAG)
-                for year in years:
-                    if genre is not None:
-                        playtime, num_songs = self.library_return_count(
-                            genre=genre, artist=artist, album=album, year=year)
-                        if num_songs > 0:
-                            files = self.library_return_list_items(
-                                'file', genre=genre, artist=artist,
-                                album=album, year=year)
-                            path = os.path.dirname(files[0])
-                            data = SongRecord(genre=genre, artist=artist,
-                                              album=album, year=year, path=path)
-                    else:
-                        playtime, num_songs = self.library_return_count(
-                            artist=artist, album=album, year=year)
-                        if num_songs > 0:
-                            files = self.library_return_list_items(
-                                'file', artist=artist, album=album, year=year)
-                            path = os.path.dirname(files[0])
-                        cache_data = SongRecord(artist=artist, album=album,
-                                                path=path)
-                        data = SongRecord(artist=artist, album=album,
-                                          year=year, path=path)
-                    if num_songs > 0:
-                        cache_data = SongRecord(artist=artist, album=album, path=path)
-                        display = misc.escape_html(album)
-                        if year and len(year) > 0 and year != self.NOTAG:
-                            display += " <span weight='light'>(%s)</span>" \
-                                    % misc.escape_html(year)
-                        display += self.add_display_info(num_songs, playtime)
-                        ordered_year = year
-                        if ordered_year == self.NOTAG:
-                            ordered_year = '9999'
-                        pb = self.artwork.get_library_artwork_cached_pb(
-                            cache_data, self.albumpb)
-                        bd += [(ordered_year + misc.lower_no_the(album),
-                                [pb, data, display])]
+                queries += [{'genre': genre, 'artist': artist, 'album': album,
+                             'year': year} for year in years]
+            counts = self.library_return_counts(queries)
+            for query, (playtime, num_songs) in zip(queries, counts):
+                if num_songs > 0:
+                    album, year = query['album'], query['year']
+                    files = self.library_return_list_items('file', **query)
+                    path = os.path.dirname(files[0])
+                    data = SongRecord(path=path, **query)
+                    display = functools.partial(self.library_album_markup,
+                                                False, num_songs, playtime)
+                    ordered_year = year
+                    if ordered_year == self.NOTAG:
+                        ordered_year = '9999'
+                    bd += [(ordered_year + misc.lower_no_the(album),
+                            [self.library_album_pixbuf, data, display])]
             # Now, songs not in albums:
             bd += self.library_populate_data_songs(genre, artist, self.NOTAG,
                                                    None)
@@ -729,17 +1026,45 @@ class Library:
             data = SongRecord(path=song.file)
             track = str(song.get('track', 99)).zfill(2)
             disc = str(song.get('disc', 99)).zfill(2)
+            display = functools.partial(self.library_song_markup, song)
             try:
                 bd += [('f' + disc + track + misc.lower_no_the(song.title),
-                        [self.sonatapb, data, formatting.parse(
-                            self.config.libraryformat, song, True)])]
+                        [self.sonatapb, data, display])]
             except:
                 bd += [('f' + disc + track + song.file.lower(),
-                        [self.sonatapb, data,
-                         formatting.parse(self.config.libraryformat, song,
-                                          True)])]
+                        [self.sonatapb, data, display])]
         return bd
 
+    # The following functions compute the icons and markups of the rows
+    # when they are displayed, see LibraryModel.
+
+    def library_row_markup(self, name, num_songs, playtime, _data):
+        return misc.escape_html(name) + \
+                self.add_display_info(num_songs, playtime)
+
+    def library_album_markup(self, show_artist, num_songs, playtime, data):
+        artist = data.artist if show_artist else None
+        year = data.year
+        display = misc.escape_html(data.album)
+        if artist and year and len(artist) > 0 and len(year) > 0 \
+           and artist != self.NOTAG and year != self.NOTAG:
+            display += " <span weight='light'>(%s, %s)</span>" \
+                    % (misc.escape_html(artist), misc.escape_html(year))
+        elif artist and len(artist) > 0 and artist != self.NOTAG:
+            display += " <span weight='light'>(%s)</span>" \
+                    % misc.escape_html(artist)
+        elif year and len(year) > 0 and year != self.NOTAG:
+            display += " <span weight='light'>(%s)</span>" \
+                    % misc.escape_html(year)
+        return display + self.add_display_info(num_songs, playtime)
+
+    def library_album_pixbuf(self, data):
+        key = SongRecord(path=data.path, artist=data.artist, album=data.album)
+        return self.artwork.get_library_artwork_cached_pb(key, self.albumpb)
+
+    def library_song_markup(self, song, _data):
+        return formatting.parse(self.config.libraryformat, song, True)
+
     def library_return_list_items(self, itemtype, genre=None, artist=None,
                                   album=None, year=None, ignore_case=True):
         # Returns all items of tag 'itemtype', in alphabetical order,
@@ -747,6 +1072,10 @@ class Library:
         # a case insensitive search, via additional 'list'
         # queries, since using a single 'list' call will be
         # case sensitive.
+        index = self.library_index_get()
+        if index is not None:
+            return index.list(itemtype, genre, artist, album, year,
+                              ignore_case)
         results = []
         searches = self.library_compose_list_count_searchlist(genre, artist,
                                                               album, year)
@@ -784,37 +1113,154 @@ class Library:
         # call 'count' for each of them. Using 'list' + 'count'
         # involves much less data to be transferred back and
         # forth than to use 'search' and count manually.
-        searches = self.library_compose_list_count_searchlist(genre, artist,
-                                                              album, year)
-        playtime = 0
-        num_songs = 0
-        for s in searches:
-            count = self.mpd.count(*s)
-            playtime += count.playtime
-            num_songs += count.songs
+        return self.library_return_counts([{'genre': genre, 'artist': artist,
+                                            'album': album, 'year': year}])[0]
+
+    def library_return_counts(self, queries):
+        # Same as library_return_count(), for each dict of arguments in
+        # queries, but sending all the 'count' commands at once.
+        index = self.library_index_get()
+        if index is not None:
+            return [index.count(**query) for query in queries]
+        searches = [self.library_compose_list_count_searchlist(**query)
+                    for query in queries]
+        with self.mpd.batch() as batch:
+            futures = [[batch.count(*s) for s in searchlist]
+                       for searchlist in searches]
+        results = []
+        for counts in futures:
+            playtime = 0
+            num_songs = 0
+            for count in counts:
+                count = count.result()
+                if count is not None:
+                    playtime += count.playtime
+                    num_songs += count.songs
+            results.append((playtime, num_songs))
+        return results
 
-        return (playtime, num_songs)
+    def library_return_grouped_counts(self, tag, queries, genre=None):
+        # Same as library_return_counts(), for queries which only differ by
+        # the value of tag. Servers supporting it (MPD 0.21+) return the
+        # counts of every value at once, in a 'count ... group tag' command
+        # per spelling of genre.
+        if self.library_index_get() is not None or \
+           self.mpd.version < (0, 21):
+            return self.library_return_counts(queries)
+        if genre is None:
+            searches = [()]
+        else:
+            searches = self.library_compose_list_count_searchlist(genre=genre)
+        with self.mpd.batch() as batch:
+            futures = [batch.count(*(s + ('group', tag))) for s in searches]
+        groups = {}
+        for future in futures:
+            result = future.result()
+            if result is None:
+                return self.library_return_counts(queries)
+            for value, count in result.items():
+                playtime, num_songs = groups.get(fold(value), (0, 0))
+                groups[fold(value)] = (playtime + count.playtime,
+                                       num_songs + count.songs)
+        counts = []
+        for query in queries:
+            if query[tag] == self.NOTAG:
+                # Songs without the tag aren't part of any group
+                counts.append(self.library_return_count(**query))
+            else:
+                counts.append(groups.get(fold(query[tag]), (0, 0)))
+        return counts
+
+    def library_return_album_counts(self, albums):
+        # Same as library_return_counts() for the rows of the album view.
+        # Servers supporting it (MPD 0.21+) count the songs of every album at
+        # once: this is exact for the albums whose name is only used by one
+        # row, the others are counted one by one.
+        queries = [{'artist': item.artist, 'album': item.album,
+                    'year': item.year} for item in albums]
+        if self.library_index_get() is not None or \
+           self.mpd.version < (0, 21):
+            return self.library_return_counts(queries)
+        groups = self.mpd.count('group', 'album')
+        if groups is None:
+            return self.library_return_counts(queries)
+        counts = {}
+        for value, count in groups.items():
+            playtime, num_songs = counts.get(fold(value), (0, 0))
+            counts[fold(value)] = (playtime + count.playtime,
+                                   num_songs + count.songs)
+        rows = collections.Counter(fold(item.album) for item in albums)
+        exact = [rows[fold(query['album'])] == 1 and \
+                 query['album'] != self.NOTAG for query in queries]
+        others = iter(self.library_return_counts(
+            [query for query, is_exact in zip(queries, exact)
+             if not is_exact]))
+        return [counts.get(fold(query['album']), (0, 0)) if is_exact
+                else next(others)
+                for query, is_exact in zip(queries, exact)]
+
+    def library_albums_set_paths(self, albums):
+        # Find the path of the albums without one whose name and year are
+        # shared by several artists: rows of the same path are then merged
+        # into a Various Artists album, and the others kept apart.
+        groups = collections.defaultdict(list)
+        for i, album in enumerate(albums):
+            if album.path is None:
+                groups[(fold(album.album or ''),
+                        fold(album.year or ''))].append(i)
+        rows = [i for group in groups.values()
+                if len(set(fold(albums[i].artist or '') for i in group)) > 1
+                for i in group]
+        if not rows:
+            return
+        paths = self.library_album_paths([albums[i] for i in rows])
+        for i, path in zip(rows, paths):
+            album = albums[i]
+            albums[i] = SongRecord(album=album.album, artist=album.artist,
+                                   year=album.year, path=path)
+
+    def library_album_paths(self, albums):
+        # Return the directory of each album, from its first song
+        with self.mpd.batch() as batch:
+            futures = []
+            for album in albums:
+                args = ['album', album.album]
+                if album.artist != VARIOUS_ARTISTS:
+                    args += ['artist', album.artist
+                             if album.artist != self.NOTAG else '']
+                args += ['date', album.year if album.year != self.NOTAG else '',
+                         'window', '0:1']
+                futures.append(batch.find(*args))
+        paths = []
+        for future in futures:
+            songs = future.result()
+            if songs:
+                paths.append(self.get_multicd_album_root_dir(
+                    os.path.dirname(songs[0]['file'])))
+            else:
+                paths.append(None)
+        return paths
 
     def library_compose_list_count_searchlist_single(self, search, typename,
-                                                     cached_list, searchlist):
+                                                     cached_map, searchlist):
+        # cached_map maps the casefolded values of the tag to their spellings,
+        # it is built the first time it is needed for each database version.
         s = []
         skip_type = (typename == 'artist' and search == VARIOUS_ARTISTS)
         if search is not None and not skip_type:
             if search == self.NOTAG:
                 itemlist = [search, '']
             else:
-                itemlist = []
-                if cached_list is None:
-                    cached_list = self.library_return_list_items(typename,
-                                                             ignore_case=False)
+                if cached_map is None:
                     # This allows us to match untagged items
-                    cached_list.append('')
-                for item in cached_list:
-                    if str(item).lower() == str(search).lower():
-                        itemlist.append(item)
+                    cached_map = {'': ['']}
+                    for item in self.library_return_list_items(
+                            typename, ignore_case=False):
+                        cached_map.setdefault(fold(item), []).append(item)
+                itemlist = cached_map.get(fold(search), [])
             if len(itemlist) == 0:
                 # There should be no results!
-                return None, cached_list
+                return None, cached_map
             for item in itemlist:
                 if len(searchlist) > 0:
                     for item2 in searchlist:
@@ -823,7 +1269,7 @@ class Library:
                     s.append((typename, item))
         else:
             s = searchlist
-        return s, cached_list
+        return s, cached_map
 
     def library_compose_list_count_searchlist(self, genre=None, artist=None,
                                               album=None, year=None):
@@ -882,8 +1328,21 @@ class Library:
                                     year=None):
         # Returns all mpd items, using mpd's 'search', along with
         # playtime and num_songs.
+        index = self.library_index_get()
+        if index is not None:
+            return index.search(genre, artist, album, year)
         searches = self.library_compose_search_searchlist(genre, artist, album,
                                                           year)
+        if self.mpd.version >= (0, 21):
+            # Filter expressions match whole values, so the results don't
+            # need to be checked, and all the combinations are sent at once.
+            with self.mpd.batch() as batch:
+                futures = [batch.search(mpdh.filter_expression(
+                    zip(s[::2], s[1::2]))) for s in searches if s]
+            results = [item for future in futures
+                       for item in future.result() or []]
+            return (results, sum(item.time for item in results),
+                    len(results))
         for s in searches:
             args_tuple = tuple(map(str, s))
             playtime = 0
@@ -905,8 +1364,8 @@ class Library:
                         # "foobar" isn't returned too
                         for arg in args_tuple[::2]:
                             if arg in item and \
-                               str(item.get(arg, '')).upper() != \
-                               str(args_tuple[pos + 1]).upper():
+                               fold(item.get(arg, '')) != \
+                               fold(args_tuple[pos + 1]):
                                 match = False
                                 break
                             pos += 2
@@ -1066,16 +1525,19 @@ class Library:
         else:
             self.library_browse(None, value)
 
-    def library_get_parent(self):
-        wd = self.config.wd
-        if self.config.lib_view == consts.VIEW_ALBUM:
+    def library_get_parent(self, wd=None, lib_view=None):
+        if wd is None:
+            wd = self.config.wd
+        if lib_view is None:
+            lib_view = self.config.lib_view
+        if lib_view == consts.VIEW_ALBUM:
             value = SongRecord(path="/")
-        elif self.config.lib_view == consts.VIEW_ARTIST:
+        elif lib_view == consts.VIEW_ARTIST:
             if wd.album is None:
                 value = SongRecord(path="/")
             else:
                 value = SongRecord(artist = wd.artist)
-        elif self.config.lib_view == consts.VIEW_GENRE:
+        elif lib_view == consts.VIEW_GENRE:
             if wd.album is not None:
                 value = SongRecord(genre=wd.genre,
                                    artist=wd.artist)
@@ -1107,45 +1569,93 @@ class Library:
         return False
 
     def get_path_child_filenames(self, return_root, selected_only=True):
-        # If return_root=True, return main directories whenever possible
-        # instead of individual songs in order to reduce the number of
-        # mpd calls we need to make. We won't want this behavior in some
-        # instances, like when we want all end files for editing tags
-        items = []
+        rows = self.library_get_rows(selected_only)
+        return self.library_rows_filenames(rows, return_root)
+
+    def library_get_rows(self, selected_only=True):
+        # Return the data of the selected rows (or of all the rows), to be
+        # passed to library_rows_filenames()
         if selected_only:
-            model, rows = self.library_selection.get_selected_rows()
+            model, paths = self.library_selection.get_selected_rows()
         else:
             model = self.librarydata
-            rows = [(i,) for i in range(len(model))]
-        for path in rows:
+            paths = [(i,) for i in range(len(model))]
+        rows = []
+        for path in paths:
             i = model.get_iter(path)
-            pb = model.get_value(i, 0)
-            data = model.get_value(i, 1)
             value = model.get_value(i, 2)
             if value != ".." and value != "/":
-                if data.path is not None and data.album is None and data.artist is None and \
-                   data.year is None and data.genre is None:
-                    if pb == self.sonatapb:
-                        # File
-                        items.append(data.path)
-                    else:
-                        # Directory
-                        if not return_root:
-                            items += self.library_get_path_files_recursive(
-                                data.path)
-                        else:
-                            items.append(data.path)
+                is_file = model.get_value(i, 0) == self.sonatapb
+                rows.append((is_file, model.get_value(i, 1)))
+        return rows
+
+    def library_rows_filenames(self, rows, return_root):
+        # If return_root=True, return main directories whenever possible
+        # instead of individual songs in order to reduce the number of
+        # mpd calls we need to make. We won't want this behavior in some
+        # instances, like when we want all end files for editing tags
+        # This doesn't touch the interface, so that it can be run from the
+        # MPD worker.
+        items = []
+        for is_file, data in rows:
+            if data.path is not None and data.album is None and data.artist is None and \
+               data.year is None and data.genre is None:
+                if is_file:
+                    # File
+                    items.append(data.path)
                 else:
-                    results, _playtime, _num_songs = \
-                            self.library_return_search_items(
-                                genre=data.genre, artist=data.artist, album=data.album,
-                                year=data.year)
-                    for item in results:
-                        items.append(item.file)
+                    # Directory
+                    if not return_root:
+                        items += self.library_get_path_files_recursive(
+                            data.path)
+                    else:
+                        items.append(data.path)
+            else:
+                results, _playtime, _num_songs = \
+                        self.library_return_search_items(
+                            genre=data.genre, artist=data.artist, album=data.album,
+                            year=data.year)
+                for item in results:
+                    items.append(item.file)
         # Make sure we don't have any EXACT duplicates:
         items = misc.remove_list_duplicates(items, case=True)
         return items
 
+    def library_rows_add(self, rows, playlist=None):
+        # Add the songs of rows to the current playlist, or to the stored
+        # playlist. Servers supporting filter expressions (MPD 0.21+) find
+        # the songs of the tag views themselves, so that they aren't
+        # transferred back and forth.
+        rows = remove_covered_rows(rows)
+        if self.mpd.version < (0, 21):
+            commands = [('add', item) for item in
+                        self.library_rows_filenames(rows, True)]
+        else:
+            commands = []
+            for _is_file, data in rows:
+                if data.album is None and data.artist is None and \
+                   data.year is None and data.genre is None:
+                    if data.path is not None:
+                        commands.append(('add', data.path))
+                    continue
+                for s in self.library_compose_search_searchlist(
+                        genre=data.genre, artist=data.artist,
+                        album=data.album, year=data.year):
+                    if s:
+                        commands.append(('searchadd', mpdh.filter_expression(
+                            zip(s[::2], s[1::2]))))
+            # Make sure we don't have any EXACT duplicates:
+            commands = misc.remove_list_duplicates(commands, case=True)
+        self.mpd.command_list_ok_begin()
+        for cmd_name, arg in commands:
+            if playlist is None:
+                getattr(self.mpd, cmd_name)(arg)
+            elif cmd_name == 'add':
+                self.mpd.playlistadd(playlist, arg)
+            else:
+                self.mpd.searchaddpl(playlist, arg)
+        self.mpd.command_list_end()
+
     def library_get_path_files_recursive(self, path):
         results = []
         for item in self.mpd.lsinfo(path):
@@ -1222,6 +1732,10 @@ class Library:
         self.libfilterbox_cond.release()
 
     def libsearchfilter_loop(self):
+        # Index the library for the search while the first letters are typed
+        index = self.library_index_get()
+        if index is not None:
+            index.prepare_search()
         while True:
             # copy the last command or pattern safely
             self.libfilterbox_cond.acquire()
@@ -1239,8 +1753,10 @@ class Library:
                                   self.searchtext)
                     return
                 elif len(todo) > 1:
-                    GLib.idle_add(self.libsearchfilter_do_search, searchby,
-                                  todo)
+                    # Query MPD from this thread, only the view is updated
+                    # from the main loop.
+                    matches = self.libsearchfilter_do_search(searchby, todo)
+                    GLib.idle_add(self.libsearchfilter_show_matches, matches)
                 elif len(todo) == 0:
                     GLib.idle_add(self.filtering_entry_revert_color,
                                   self.searchtext)
@@ -1258,14 +1774,23 @@ class Library:
             self.prevlibtodo = todo
 
     def libsearchfilter_do_search(self, searchby, todo):
+        # Return the matching songs, the best matches first
+        index = self.library_index_get()
+        if index is not None:
+            # Answered from memory, without querying MPD
+            return index.find(searchby, todo)
+
         if not self.prevlibtodo_base in todo:
             # Do library search based on first two letters:
+            try:
+                self.prevlibtodo_base_results = list(
+                    self.mpd.iterate('search', searchby, todo[:2]))
+            except (socket.error, mpd.MPDError):
+                # Searched again with the next pattern
+                self.prevlibtodo_base = "__"
+                self.prevlibtodo_base_results = []
+                return []
             self.prevlibtodo_base = todo[:2]
-            self.prevlibtodo_base_results = self.mpd.search(searchby,
-                                                             self.prevlibtodo_base)
-            subsearch = False
-        else:
-            subsearch = True
 
         # Now, use filtering similar to playlist filtering:
         # this make take some seconds... and we'll escape the search text
@@ -1301,33 +1826,23 @@ class Library:
                         break
                 if is_match:
                     matches.append(row)
-        if subsearch and len(matches) == len(self.librarydata):
-            # nothing changed..
-            return
-        self.library.freeze_child_notify()
-        currlen = len(self.librarydata)
-        bd = [(self.sonatapb,
+        query = ' '.join(fold(word) for word in todo.split())
+        if searchby != 'any':
+            rank = lambda row: search_rank(fold(row.get(searchby, '')), query)
+        else:
+            rank = lambda row: min(search_rank(fold(value), query)
+                                   for value in row.values())
+        matches.sort(key=rank)
+        return matches
+
+    def libsearchfilter_show_matches(self, matches):
+        # The songs are only formatted once shown, so that the first ones
+        # appear at once whatever the number of matches.
+        bd = [[self.sonatapb,
                SongRecord(path=item['file']),
-               formatting.parse(self.config.libraryformat, item, True))
+               functools.partial(self.library_song_markup, item)]
               for item in matches if 'file' in item]
-        bd.sort(key=lambda key: locale.strxfrm(key[2]))
-        for i, item in enumerate(bd):
-            if i < currlen:
-                j = self.librarydata.get_iter((i, ))
-                for index in range(len(item)):
-                    if item[index] != self.librarydata.get_value(j, index):
-                        self.librarydata.set_value(j, index, item[index])
-            else:
-                self.librarydata.append(item)
-        # Remove excess items...
-        newlen = len(bd)
-        if newlen == 0:
-            self.librarydata.clear()
-        else:
-            for i in range(currlen - newlen):
-                j = self.librarydata.get_iter((currlen - 1 - i,))
-                self.librarydata.remove(j)
-        self.library.thaw_child_notify()
+        self.library_set_rows(bd)
         if len(matches) == 0:
             GLib.idle_add(self.filtering_entry_make_red, self.searchtext)
         else:
@@ -0,0 +1,300 @@
+import array
+import collections
+import locale
+import logging
+import os
+import pickle
+
+from sonata import misc
+from sonata.mpdhelper import MPDSong
+
+
+logger = logging.getLogger(__name__)
+
+# Tags which can be used to browse the library
+INDEXED_TAGS = ('genre', 'artist', 'album', 'date')
+
+# Fields of the songs which the search filter doesn't look into
+UNSEARCHED_FIELDS = ('last-modified',)
+
+# Version of the format of the saved indexes, to be increased when it changes
+FORMAT = 1
+
+
+def fold(value):
+    """Return the key under which `value` is indexed, so that tags differing
+    only by their case or Unicode normalization are considered equal."""
+    return misc.casefold(str(value))
+
+
+def search_rank(value, query):
+    """Return how well the folded `value` matches the folded `query` of the
+    search filter: 0 if they are equal, 1 if it starts with it, 2 otherwise.
+    """
+    if value == query:
+        return 0
+    if value.startswith(query):
+        return 1
+    return 2
+
+
+def trigrams(text):
+    """Return the set of the substrings of 3 characters of `text`."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class LibraryIndex:
+    """
+    The songs of the MPD database, indexed by their tags
+
+    The library views need, for a given genre, artist, album and year, the
+    list of the matching values of another tag, and the number and total
+    playtime of the matching songs. Answering this from memory saves sending
+    a 'list' and a 'count' command per row, which is very slow for big
+    libraries.
+
+    Tag values are compared without regard to case, like the views do.
+    `notag` matches the songs which don't have the tag, and `various_artists`
+    matches any artist.
+
+    Example usage:
+    index = LibraryIndex(client.listallinfo('/'), stats['db_update'],
+                         _("Untagged"), _("Various Artists"))
+    index.list('album', artist='Foo')  # ['Bar', 'Baz']
+    index.count(artist='Foo', album='Bar')  # (playtime, number of songs)
+    index.search(artist='Foo', album='Bar')  # [MPDSong, ...]
+    index.find('any', 'foo ba')  # Songs with 'foo' and 'ba' in their tags
+    index.save(filename)
+    # Later, without scanning the whole database again:
+    index = LibraryIndex.load(filename, _("Untagged"), _("Various Artists"))
+    if index.version != stats['db_update']:
+        index.update(client.find('modified-since', index.version),
+                     version=stats['db_update'])
+    """
+
+    def __init__(self, songs, version, notag, various_artists):
+        self.version = version
+        self.notag = notag
+        self.various_artists = various_artists
+        self.songs = [song for song in songs if 'file' in song]
+        self._by_tag = {tag: {} for tag in INDEXED_TAGS}
+        # The index of the search filter, see _search_index()
+        self._search = None
+        for song in self.songs:
+            for tag, index in self._by_tag.items():
+                index.setdefault(self._key(song.get(tag)), []).append(song)
+
+    def __len__(self):
+        return len(self.songs)
+
+    @classmethod
+    def load(cls, filename, notag, various_artists):
+        """Return the index saved in `filename`, or None if there is none.
+        Its version should be checked against the one of the database."""
+        try:
+            with open(filename, 'rb') as f:
+                index_format, version = pickle.load(f)
+                if index_format != FORMAT:
+                    return None
+                songs = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError) as e:
+            logger.warning("Can't load the library index %r: %s", filename, e)
+            return None
+        return cls((MPDSong(dict(items)) for items in songs), version, notag,
+                   various_artists)
+
+    def save(self, filename):
+        """Save the index to `filename`, see load()."""
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump((FORMAT, self.version), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump([tuple(song.items()) for song in self.songs], f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, filename)
+        except (IOError, pickle.PicklingError) as e:
+            logger.warning("Can't save the library index %r: %s", filename, e)
+
+    def update(self, songs, removed=(), version=None):
+        """Add `songs` to the index, replacing the ones with the same file,
+        and remove the songs whose file is in `removed`.
+
+        Only the entries of the tags of these songs are updated, by replacing
+        their lists, so the index can be read by other threads meanwhile.
+        """
+        songs = {song.file: song for song in songs if 'file' in song}
+        files = set(removed) | set(songs)
+        old_songs = [song for song in self.songs if song.file in files]
+        if old_songs or songs:
+            new_songs = dict(songs)
+            result = []
+            for song in self.songs:
+                if song.file in new_songs:
+                    # Keep the position of the updated songs
+                    result.append(new_songs.pop(song.file))
+                elif song.file not in files:
+                    result.append(song)
+            result.extend(new_songs.values())
+            self.songs = result
+            self._search = None
+            for tag, index in self._by_tag.items():
+                keys = {self._key(song.get(tag))
+                        for song in old_songs + list(songs.values())}
+                for key in keys:
+                    kept = [song for song in index.get(key, [])
+                            if song.file not in files]
+                    added = [song for song in songs.values()
+                             if self._key(song.get(tag)) == key]
+                    if kept or added:
+                        index[key] = kept + added
+                    else:
+                        index.pop(key, None)
+        if version is not None:
+            self.version = version
+
+    def _key(self, value):
+        # Untagged songs are all indexed under ''
+        if not value or fold(value) == fold(self.notag):
+            return ''
+        return fold(value)
+
+    def select(self, genre=None, artist=None, album=None, year=None):
+        """Return the songs matching all the given tags, in database
+        order."""
+        filters = [(tag, self._key(value))
+                   for tag, value in (('genre', genre), ('artist', artist),
+                                      ('album', album), ('date', year))
+                   if value is not None and not \
+                   (tag == 'artist' and value == self.various_artists)]
+        if not filters:
+            return self.songs
+
+        # Start from the smallest set of songs, and check the other tags on
+        # each of them.
+        filters.sort(key=lambda f: len(self._by_tag[f[0]].get(f[1], [])))
+        tag, key = filters[0]
+        songs = self._by_tag[tag].get(key, [])
+        if len(filters) > 1:
+            songs = [song for song in songs
+                     if all(self._key(song.get(tag)) == key
+                            for tag, key in filters[1:])]
+        return songs
+
+    def list(self, itemtype, genre=None, artist=None, album=None, year=None,
+             ignore_case=True):
+        """Return the values of `itemtype` for the songs matching the given
+        tags, in alphabetical order."""
+        if itemtype in self._by_tag and genre is None and artist is None \
+           and album is None and year is None and ignore_case:
+            # Each key of the index already stands for a value
+            results = [songs[0][itemtype]
+                       for key, songs in self._by_tag[itemtype].items()
+                       if key]
+        else:
+            songs = self.select(genre, artist, album, year)
+            results = misc.remove_list_duplicates(
+                [song.get(itemtype) for song in songs
+                 if song.get(itemtype)])
+            if ignore_case:
+                results = list(misc.iunique(results, fold))
+        results.sort(key=locale.strxfrm)
+        return results
+
+    def count(self, genre=None, artist=None, album=None, year=None):
+        """Return the total playtime and the number of songs matching the
+        given tags."""
+        songs = self.select(genre, artist, album, year)
+        return sum(song.time for song in songs), len(songs)
+
+    def search(self, genre=None, artist=None, album=None, year=None):
+        """Same as count(), returning the songs first."""
+        songs = list(self.select(genre, artist, album, year))
+        return songs, sum(song.time for song in songs), len(songs)
+
+    def find(self, field, text):
+        """Return the songs whose `field` contains every word of `text`,
+        regardless of case. The 'any' field stands for all of them.
+
+        The songs with a value equal to `text` come first, then the ones
+        with a value starting with it, then the others, each in database
+        order (see search_rank()).
+        """
+        songs, values, songs_of, by_field, postings = self._search_index()
+        query = ' '.join(fold(word) for word in text.split())
+        words = sorted(set(query.split()), key=len, reverse=True)
+        result = None
+        # The songs of the values equal to the query, and starting with it
+        ranked = ([], [])
+        for word in words:
+            # The values containing the word are among the ones containing
+            # all of its trigrams.
+            lists = [postings.get(trigram, ())
+                     for trigram in trigrams(word)]
+            if lists:
+                lists.sort(key=len)
+                candidates = set(lists[0])
+                for ids in lists[1:]:
+                    candidates.intersection_update(ids)
+            elif field == 'any':
+                candidates = range(len(values))
+            else:
+                candidates = by_field.get(field, ())
+            found = set()
+            for value_id in candidates:
+                value_field, value = values[value_id]
+                if word in value and (field == 'any' or value_field == field):
+                    found.update(songs_of[value_id])
+                    # Values matching the query contain its longest word
+                    rank = search_rank(value, query) if result is None else 2
+                    if rank < 2:
+                        ranked[rank].append(songs_of[value_id])
+            result = found if result is None else result & found
+            if not result:
+                return []
+        if result is None:
+            return list(songs)
+        ids = []
+        for lists in ranked:
+            found = result.intersection(set().union(*lists))
+            ids += sorted(found)
+            result -= found
+        ids += sorted(result)
+        return [songs[i] for i in ids]
+
+    def prepare_search(self):
+        """Build the index used by find(), which otherwise happens on the
+        first search."""
+        self._search_index()
+
+    def _search_index(self):
+        # The search filter looks for words in the distinct values of the
+        # fields of the songs, found from their trigrams. This is built on
+        # the first search, as it takes a while, and again after updates.
+        search = self._search
+        if search is not None:
+            return search
+        songs = self.songs
+        values = []  # (field, folded value)
+        value_ids = {}
+        songs_of = []  # For each value, the indexes of its songs
+        by_field = collections.defaultdict(list)  # Field -> value indexes
+        postings = collections.defaultdict(lambda: array.array('I'))
+        for i, song in enumerate(songs):
+            for field, value in song.items():
+                if field in UNSEARCHED_FIELDS:
+                    continue
+                key = (field, fold(value))
+                value_id = value_ids.get(key)
+                if value_id is None:
+                    value_id = value_ids[key] = len(values)
+                    values.append(key)
+                    songs_of.append(array.array('I'))
+                    by_field[field].append(value_id)
+                    for trigram in trigrams(key[1]):
+                        postings[trigram].append(value_id)
+                songs_of[value_id].append(i)
+        search = self._search = (songs, values, songs_of, dict(by_field),
+                                 dict(postings))
+        return search
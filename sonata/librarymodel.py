@@ -0,0 +1,156 @@
+import collections
+
+from gi.repository import Gtk, GdkPixbuf, GObject
+
+
+class LibraryModel(GObject.Object, Gtk.TreeModel):
+    """A list model for the library view, computing its rows when shown
+
+    Each row is a list of a pixbuf, the data of the row (a SongRecord), and
+    its markup. The pixbuf and the markup can be given as functions taking
+    the data as argument: they are only called when the row is displayed,
+    and their results are kept for the last CACHE_SIZE rows only. This
+    keeps the memory used and the time needed to show a level constant,
+    whatever the number of rows.
+
+    Example usage:
+    model = LibraryModel()
+    treeview.set_model(None)
+    model.set_rows([[pb, data, functools.partial(render_markup, item)]])
+    treeview.set_model(model)
+    """
+
+    CACHE_SIZE = 1000
+    COLUMN_TYPES = (GdkPixbuf.Pixbuf, GObject.TYPE_PYOBJECT, str)
+
+    def __init__(self):
+        super().__init__()
+        self._rows = []
+        self._cache = collections.OrderedDict()
+        self._stamp = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def set_rows(self, rows):
+        """Replace all the rows by the list `rows`, which is kept and
+        extended by extend(). No signal is emitted for them, so the model
+        should be removed from its views meanwhile."""
+        self._stamp += 1
+        self._cache.clear()
+        self._rows = rows
+
+    def extend(self, rows):
+        """Append `rows`, signaling each of them."""
+        start = len(self._rows)
+        self._rows.extend(rows)
+        for index in range(start, len(self._rows)):
+            self.row_inserted(Gtk.TreePath((index,)), self._iter(index)[1])
+
+    def clear(self):
+        for index in reversed(range(len(self._rows))):
+            self._rows.pop()
+            self.row_deleted(Gtk.TreePath((index,)))
+        self.set_rows([])
+
+    def iter_is_valid(self, treeiter):
+        return treeiter.stamp == self._stamp and \
+                0 <= self._index(treeiter) < len(self._rows)
+
+    def set_value(self, treeiter, column, value):
+        index = self._index(treeiter)
+        row = self._rows[index]
+        if callable(row[column]):
+            # Only until the row is computed again
+            self._cached(index, column, value)
+        else:
+            row[column] = value
+            if column == 1:
+                # The other values are computed from the data
+                for key in [(index, 0), (index, 2)]:
+                    self._cache.pop(key, None)
+        self.row_changed(Gtk.TreePath((index,)), treeiter)
+
+    def _cached(self, index, column, value):
+        self._cache[(index, column)] = value
+        self._cache.move_to_end((index, column))
+        while len(self._cache) > self.CACHE_SIZE * 2:
+            try:
+                self._cache.popitem(last=False)
+            except KeyError:
+                break
+
+    def _iter(self, index):
+        if not 0 <= index < len(self._rows):
+            return (False, None)
+        treeiter = Gtk.TreeIter()
+        treeiter.stamp = self._stamp
+        # A null user_data would be read back as None
+        treeiter.user_data = index + 1
+        return (True, treeiter)
+
+    def _index(self, treeiter):
+        return (treeiter.user_data or 0) - 1
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, column):
+        return self.COLUMN_TYPES[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) != 1:
+            return (False, None)
+        return self._iter(indices[0])
+
+    def do_get_path(self, treeiter):
+        return Gtk.TreePath((self._index(treeiter),))
+
+    def do_get_value(self, treeiter, column):
+        index = self._index(treeiter)
+        value = self._rows[index][column]
+        if not callable(value):
+            return value
+        key = (index, column)
+        try:
+            # The artwork thread reads the model too, so the entry can be
+            # gone between the two calls.
+            cached = self._cache[key]
+            self._cache.move_to_end(key)
+            return cached
+        except KeyError:
+            pass
+        value = value(self._rows[index][1])
+        self._cached(index, column, value)
+        return value
+
+    def do_iter_next(self, treeiter):
+        return self._iter(self._index(treeiter) + 1)
+
+    def do_iter_previous(self, treeiter):
+        return self._iter(self._index(treeiter) - 1)
+
+    def do_iter_children(self, parent):
+        if parent is not None:
+            return (False, None)
+        return self._iter(0)
+
+    def do_iter_has_child(self, treeiter):
+        return False
+
+    def do_iter_n_children(self, treeiter):
+        if treeiter is not None:
+            return 0
+        return len(self._rows)
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is not None:
+            return (False, None)
+        return self._iter(n)
+
+    def do_iter_parent(self, child):
+        return (False, None)
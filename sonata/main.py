@@ -30,6 +30,7 @@ import re
 import gc
 import shutil
 import threading
+import time
 
 from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, Pango
 
@@ -85,6 +86,7 @@ class Base:
         self.lyrics_search_dialog = None
 
         self.mpd = mpdh.MPDClient()
+        self.idle_listener = mpdh.MPDIdleListener(self.on_mpd_idle)
         self.conn = False
         # Anything != than self.conn, to actually refresh the UI at startup.
         self.prevconn = not self.conn
@@ -103,7 +105,26 @@ class Base:
         self.iterate_time_when_connected = 500
         # Slow down polling when disconnected stopped
         self.iterate_time_when_disconnected_or_stopped = 1000
-
+        # When MPD notifies us about changes through the idle listener, we
+        # don't poll at all; we only need to move the progress bar forward.
+        self.iterate_time_when_idle = 1000
+        # When the last status was received, and the elapsed time of the
+        # current song at that moment:
+        self.status_received = None
+        self.status_elapsed = 0
+        # After a failed connection, wait before trying again, doubling the
+        # delay (in seconds) after each failure:
+        self.reconnect_delay_min = 1
+        self.reconnect_delay_max = 60
+        self.reconnect_delay = self.reconnect_delay_min
+        self.reconnect_time = 0
+        # Set when the connection was lost, rather than closed by the user:
+        # the models are kept, and updated once we are connected again.
+        self.connection_lost = False
+        # When the MPD server was started, and whether it was restarted
+        # since we were last connected:
+        self.mpd_started = None
+        self.mpd_restarted = False
 
         self.trying_connection = False
 
@@ -950,8 +971,19 @@ class Base:
             test = self.mpd.status()
             if test:
                 self.conn = True
+                self.reconnect_delay = self.reconnect_delay_min
+                self.mpd.start_idle_listener(self.idle_listener)
+                stats = self.mpd.stats()
+                if stats:
+                    started = time.time() - int(stats['uptime'])
+                    self.mpd_restarted = self.mpd_started is None or \
+                            abs(started - self.mpd_started) > 10
+                    self.mpd_started = started
             else:
                 self.conn = False
+                self.reconnect_time = time.monotonic() + self.reconnect_delay
+                self.reconnect_delay = min(self.reconnect_delay * 2,
+                                           self.reconnect_delay_max)
         else:
             self.conn = False
         if not self.conn:
@@ -964,10 +996,16 @@ class Base:
         self.trying_connection = False
 
     def mpd_disconnect(self):
+        self.idle_listener.stop()
         if self.conn:
             self.mpd.close()
             self.mpd.disconnect()
             self.conn = False
+        elif self.connection_lost:
+            # The models were kept for when the connection is back, which
+            # won't happen now.
+            self.connection_lost = False
+            self.handle_change_conn()
 
     def on_connectkey_pressed(self, _event=None):
         self.user_connect = True
@@ -990,51 +1028,112 @@ class Base:
         # Disconnect:
         self.mpd_disconnect()
 
-    def update_status(self):
+    def update_status(self, songinfo=True, callback=None):
+        # Fetch the status (and the current song) in the MPD worker, so that
+        # the interface doesn't wait for the server. `callback` is called
+        # once the new status has been set.
+        if not self.conn and time.monotonic() >= self.reconnect_time:
+            self.mpd_connect()
+        if self.conn:
+            self.mpd.run_async(self.fetch_status, songinfo,
+                               callback=lambda result: self.set_status(
+                                   result, callback))
+        else:
+            self.set_status(None, callback)
+
+    def fetch_status(self, songinfo):
+        # Runs in the MPD worker thread
+        status = self.mpd.status()
+        if not status:
+            return None
+        if songinfo:
+            return status, True, self.mpd.currentsong()
+        return status, False, None
+
+    def set_status(self, result, callback=None):
         try:
-            if not self.conn:
-                self.mpd_connect()
-            if self.conn:
+            if self.conn and result is not None:
+                self.status, has_songinfo, songinfo = result
                 self.iterate_time = self.iterate_time_when_connected
-                self.status = self.mpd.status()
-                if self.status:
-                    if self.status['state'] == 'stop':
-                        self.iterate_time = \
-                                self.iterate_time_when_disconnected_or_stopped
-                    self.songinfo = self.mpd.currentsong()
+                self.status_received = time.monotonic()
+                self.status_elapsed = float(self.status.get(
+                    'elapsed', self.status.get('time', '0').split(':')[0]))
+                if self.idle_listener.active:
+                    self.iterate_time = self.iterate_time_when_idle
+                elif self.status['state'] == 'stop':
+                    self.iterate_time = \
+                            self.iterate_time_when_disconnected_or_stopped
+                if has_songinfo:
+                    self.songinfo = songinfo
                     self.artwork.update_songinfo(self.songinfo)
-                    if not self.last_repeat \
-                       or self.last_repeat != self.status['repeat']:
-                        self.repeatmenu.set_active(
-                            self.status['repeat'] == '1')
-                    if not self.last_random \
-                       or self.last_random != self.status['random']:
-                        self.randommenu.set_active(
-                            self.status['random'] == '1')
-                    if not self.last_consume or self.last_consume != self.status['consume']:
-                        self.consumemenu.set_active(self.status['consume'] == '1')
-                    if self.status['xfade'] == '0':
-                        self.config.xfade_enabled = False
-                    else:
-                        self.config.xfade_enabled = True
-                        self.config.xfade = int(self.status['xfade'])
-                        if self.config.xfade > 30:
-                            self.config.xfade = 30
-                    self.last_repeat = self.status['repeat']
-                    self.last_random = self.status['random']
-                    self.last_consume = self.status['consume']
-                    return
+                if not self.last_repeat \
+                   or self.last_repeat != self.status['repeat']:
+                    self.repeatmenu.set_active(
+                        self.status['repeat'] == '1')
+                if not self.last_random \
+                   or self.last_random != self.status['random']:
+                    self.randommenu.set_active(
+                        self.status['random'] == '1')
+                if not self.last_consume or self.last_consume != self.status['consume']:
+                    self.consumemenu.set_active(self.status['consume'] == '1')
+                if self.status['xfade'] == '0':
+                    self.config.xfade_enabled = False
+                else:
+                    self.config.xfade_enabled = True
+                    self.config.xfade = int(self.status['xfade'])
+                    if self.config.xfade > 30:
+                        self.config.xfade = 30
+                self.last_repeat = self.status['repeat']
+                self.last_random = self.status['random']
+                self.last_consume = self.status['consume']
+                if callback is not None:
+                    callback()
+                return
         except:
             pass
+        self.idle_listener.stop()
+        if self.conn and self.user_connect:
+            self.connection_lost = True
         self.prevstatus = self.status
         self.prevsonginfo = self.songinfo
         self.conn = False
         self.status = None
         self.songinfo = None
         self.artwork.update_songinfo(self.songinfo)
+        if callback is not None:
+            callback()
+
+    def update_elapsed_time(self):
+        # MPD doesn't notify about the progress of the current song, so
+        # compute it from the last status we received instead of polling.
+        if self.status is None or self.status.get('state') != 'play' \
+           or 'time' not in self.status:
+            return
+        total = int(self.status['time'].split(':')[1])
+        elapsed = self.status_elapsed + time.monotonic() - \
+                self.status_received
+        if total > 0:
+            elapsed = min(elapsed, total)
+        status = dict(self.status)
+        status['elapsed'] = "%.3f" % elapsed
+        status['time'] = "%d:%d" % (elapsed, total)
+        self.status = status
+
+    def on_mpd_idle(self, changed):
+        # Called by the idle listener with the MPD subsystems which changed
+        if not self.conn:
+            return
+        if changed & {'player', 'mixer', 'options', 'playlist', 'update'}:
+            self.update_status(songinfo=bool(changed & {'player',
+                                                        'playlist'}),
+                               callback=self.handle_changes)
+        if 'database' in changed:
+            self.mpd_updated_db()
+        elif 'stored_playlist' in changed:
+            # 'listplaylists' isn't cached, the view only has to be refreshed
+            self.playlists.populate()
 
-    def iterate(self):
-        self.update_status()
+    def handle_changes(self):
         self.info_update(False)
 
         # XXX: this is subject to race condition, since self.conn can be
@@ -1055,6 +1154,15 @@ class Base:
         self.prevstatus = self.status
         self.prevsonginfo = self.songinfo
 
+    def iterate(self):
+        if self.conn and self.idle_listener.active \
+           and self.status_received is not None:
+            self.iterate_time = self.iterate_time_when_idle
+            self.update_elapsed_time()
+            self.handle_changes()
+        else:
+            self.update_status(callback=self.handle_changes)
+
         # Repeat ad infitum..
         self.iterate_handler = GLib.timeout_add(self.iterate_time, self.iterate)
 
@@ -1156,11 +1264,15 @@ class Base:
                                 self.prevbutton, self.nextbutton,
                                 self.volumebutton):
                 mediabutton.set_property('sensitive', False)
-            self.currentdata.clear()
-            if self.current_treeview.get_model():
-                self.current_treeview.get_model().clear()
+            if not self.connection_lost:
+                self.currentdata.clear()
+                if self.current_treeview.get_model():
+                    self.current_treeview.get_model().clear()
             self.tray_icon.update_icon('sonata-disconnect')
             self.info_update(True)
+            # The database may have changed, or be another one, by the time
+            # we are connected again.
+            self.library.view_caches_reset()
             if self.current.filterbox_visible:
                 GLib.idle_add(self.current.searchfilter_toggle, None)
             if self.library.search_visible():
@@ -1173,7 +1285,11 @@ class Base:
                                 self.volumebutton):
                 mediabutton.set_property('sensitive', True)
             if self.sonata_loaded:
-                self.library.library_browse(root=SongRecord(path="/"))
+                if self.connection_lost:
+                    # Stay where we were
+                    self.library.library_browse(root=self.config.wd)
+                else:
+                    self.library.library_browse(root=SongRecord(path="/"))
             self.playlists.populate()
             self.streams.populate()
             self.on_notebook_page_change(self.notebook, 0,
@@ -1251,55 +1367,86 @@ class Base:
     def on_add_item_play(self, widget):
         self.on_add_item(widget, True)
 
-    def on_add_item(self, _widget, play_after=False):
-        if self.conn:
-            if play_after and self.status:
-                playid = self.status['playlistlength']
-            if self.current_tab == self.TAB_LIBRARY:
-                items = self.library.get_path_child_filenames(True)
-                self.mpd.command_list_ok_begin()
-                for item in items:
-                    self.mpd.add(item)
-                self.mpd.command_list_end()
-            elif self.current_tab == self.TAB_PLAYLISTS:
-                model, selected = self.playlists_selection.get_selected_rows()
-                for path in selected:
-                    self.mpd.load(
-                              misc.unescape_html(
-                                  model.get_value(model.get_iter(path), 1)))
-            elif self.current_tab == self.TAB_STREAMS:
-                model, selected = self.streams_selection.get_selected_rows()
-                for path in selected:
-                    item = model.get_value(model.get_iter(path), 2)
+    def on_add_item(self, _widget, play_after=False, replace=False):
+        if not self.conn:
+            return
+        # Collect the selected items here, then add them from the MPD
+        # worker so that the interface doesn't wait for the server. When
+        # replacing, the playlist is cleared from there too: another
+        # connection could clear it after the items are added.
+        if self.current_tab == self.TAB_LIBRARY:
+            rows = self.library.library_get_rows()
+            def add_items():
+                self.library.library_rows_add(rows)
+        elif self.current_tab == self.TAB_PLAYLISTS:
+            model, selected = self.playlists_selection.get_selected_rows()
+            names = [misc.unescape_html(model.get_value(model.get_iter(path),
+                                                        1))
+                     for path in selected]
+            def add_items():
+                with self.mpd.batch() as batch:
+                    for name in names:
+                        batch.load(name)
+        elif self.current_tab == self.TAB_STREAMS:
+            model, selected = self.streams_selection.get_selected_rows()
+            streams = [model.get_value(model.get_iter(path), 2)
+                       for path in selected]
+            def add_items():
+                for item in streams:
                     self.stream_parse_and_add(item)
-            self.iterate_now()
-            if play_after:
-                if self.status['random'] == '1':
+        else:
+            return
+
+        def add_and_play():
+            if replace:
+                self.mpd.clear()
+            status = self.mpd.status()
+            add_items()
+            if play_after and status:
+                if status['random'] == '1':
                     # If we are in random mode, we want to play a random song
                     # instead:
                     self.mpd.play()
                 else:
-                    self.mpd.play(int(playid))
+                    self.mpd.play(int(status['playlistlength']))
+
+        if self.current_tab == self.TAB_STREAMS:
+            # Streams may need to be downloaded first, don't block the MPD
+            # worker meanwhile.
+            def add_streams():
+                add_and_play()
+                GLib.idle_add(self.iterate_now)
+            thread = threading.Thread(target=add_streams)
+            thread.daemon = True
+            thread.start()
+        else:
+            self.mpd.run_async(add_and_play,
+                               callback=lambda _result: self.iterate_now(),
+                               purpose='bulk')
 
     def add_selected_to_playlist(self, plname):
         if self.current_tab == self.TAB_LIBRARY:
-            songs = self.library.get_path_child_filenames(True)
+            rows = self.library.library_get_rows()
+            self.mpd.run_async(self.library.library_rows_add, rows, plname,
+                               purpose='bulk')
+            return
         elif self.current_tab == self.TAB_CURRENT:
             songs = self.current.get_selected_filenames(0)
         else:
             raise Exception("This tab doesn't support playlists")
 
-        self.mpd.command_list_ok_begin()
-        for song in songs:
-            self.mpd.playlistadd(plname, song)
-        self.mpd.command_list_end()
+        def add_songs():
+            self.mpd.command_list_ok_begin()
+            for song in songs:
+                self.mpd.playlistadd(plname, song)
+            self.mpd.command_list_end()
+        self.mpd.run_async(add_songs, purpose='bulk')
 
     def stream_parse_and_add(self, item):
         # We need to do different things depending on if this is
         # a normal stream, pls, m3u, etc..
         # Note that we will only download the first 4000 bytes
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+        # This is run outside of the main loop, see on_add_item().
         f = None
         try:
             request = urllib.request.Request(item)
@@ -1317,8 +1464,6 @@ class Base:
                     f = opener.open(request).read(4000)
                 except:
                     pass
-        while Gtk.events_pending():
-            Gtk.main_iteration()
         if f:
             if misc.is_binary(f):
                 # Binary file, just add it:
@@ -1378,8 +1523,7 @@ class Base:
             return
         if num_selected == 0:
             return
-        self.mpd_clear(None)
-        self.on_add_item(widget, play_after)
+        self.on_add_item(widget, play_after, replace=True)
         self.iterate_now()
 
     def menu_position(self, _menu):
@@ -1413,6 +1557,18 @@ class Base:
         else:
             return (self.config.x + 250, self.config.y + 80, True)
 
+    def playlist_resync_version(self):
+        # Once connected again after losing the connection, return the
+        # version of the playlist we have, if MPD can send the changes since
+        # then, or None to reload the whole playlist.
+        version = self.current.playlist_version
+        if version is None or self.mpd_restarted:
+            # The versions of MPD's playlist start over when it is restarted
+            return None
+        if int(self.status['playlist']) < int(version):
+            return None
+        return version
+
     def handle_change_status(self):
         # Called when one of the following items are changed:
         #  1. Current playlist (song added, removed, etc)
@@ -1426,7 +1582,7 @@ class Base:
             self.update_wintitle()
             self.playing_song_change()
             self.update_statusbar()
-            if not self.conn:
+            if not self.conn and not self.connection_lost:
                 self.librarydata.clear()
                 self.playlistsdata.clear()
                 self.streamsdata.clear()
@@ -1438,8 +1594,12 @@ class Base:
             prevstatus_playlist = None
             if self.prevstatus:
                 prevstatus_playlist = self.prevstatus['playlist']
+            elif self.connection_lost:
+                prevstatus_playlist = self.playlist_resync_version()
             self.current.current_update(prevstatus_playlist,
-                                        self.status['playlistlength'])
+                                        self.status['playlistlength'],
+                                        self.status['playlist'])
+        self.connection_lost = False
 
         # Update progress frequently if we're playing
         if self.status_is_play_or_pause():
@@ -1502,10 +1662,15 @@ class Base:
             elif self.prevstatus is None \
                     or mpdh.mpd_is_updating(self.prevstatus) \
                     != mpdh.mpd_is_updating(self.status):
-                if not mpdh.mpd_is_updating(self.status):
+                if self.prevstatus is not None \
+                   and self.idle_listener.active:
+                    # Done updating; the idle listener tells us whether the
+                    # database actually changed.
+                    self.update_statusbar(False)
+                else:
                     # Done updating, refresh interface
                     self.mpd_updated_db()
-            elif self.mpd_update_queued:
+            elif self.mpd_update_queued and not self.idle_listener.active:
                 # If the update happens too quickly, we won't catch it in
                 # our polling. So let's force an update of the interface:
                 self.mpd_updated_db()
@@ -1532,6 +1697,7 @@ class Base:
                                                     self.prevsonginfo)
 
     def mpd_updated_db(self):
+        self.mpd.invalidate_cache()
         self.library.view_caches_reset()
         self.update_statusbar(False)
         # We need to make sure that we update the artist in case tags
@@ -2012,9 +2178,7 @@ class Base:
             if not self.status or self.status['playlistlength'] == '0':
                 return
             ui.change_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            self.mpd.shuffle()
+            self.mpd.call_async('shuffle')
 
     def on_menu_popup(self, _widget):
         self.update_menu_visibility()
@@ -2025,7 +2189,8 @@ class Base:
         if self.conn:
             if self.library.search_visible():
                 self.library.on_search_end(None)
-            self.mpd.update('/') # XXX we should pass a list here!
+            # XXX we should pass a list here!
+            self.mpd.run_async(self.mpd.update, '/')
             self.mpd_update_queued = True
 
     def on_updatedb_shortcut(self, _action):
@@ -2040,10 +2205,12 @@ class Base:
         if self.conn and self.current_tab == self.TAB_LIBRARY:
             if self.library.search_visible():
                 self.library.on_search_end(None)
-            filenames = self.library.get_path_child_filenames(True,
-                                                              selected_only)
-            if len(filenames) > 0:
-                self.mpd.update(filenames)
+            rows = self.library.library_get_rows(selected_only)
+            if len(rows) > 0:
+                self.mpd.run_async(
+                    lambda: self.mpd.update(
+                        self.library.library_rows_filenames(rows, True)),
+                    purpose='bulk')
                 self.mpd_update_queued = True
 
     def calc_info_image_size(self):
@@ -2227,7 +2394,6 @@ class Base:
             data = SongRecord(album=album, artist=artist, year=year, path=path)
             datalist.append(data)
         if len(datalist) > 0:
-            datalist = misc.remove_list_duplicates(datalist, case=False)
             datalist = library.list_mark_various_artists_albums(datalist)
             if len(datalist) > 0:
                 # Multiple albums with same name and year, choose the
@@ -2653,29 +2819,29 @@ class Base:
         self.volumebutton.set_value(new_volume)
 
     def on_volume_change(self, _button, new_volume):
-        self.mpd.setvol(int(new_volume))
+        self.mpd.call_async('setvol', int(new_volume))
 
     def mpd_pp(self, _widget, _key=None):
         if self.conn and self.status:
             if self.status['state'] in ('stop', 'pause'):
-                self.mpd.play()
+                self.mpd.call_async('play')
             elif self.status['state'] == 'play':
-                self.mpd.pause('1')
+                self.mpd.call_async('pause', '1')
             self.iterate_now()
 
     def mpd_stop(self, _widget, _key=None):
         if self.conn:
-            self.mpd.stop()
+            self.mpd.call_async('stop')
             self.iterate_now()
 
     def mpd_prev(self, _widget, _key=None):
         if self.conn:
-            self.mpd.previous()
+            self.mpd.call_async('previous')
             self.iterate_now()
 
     def mpd_next(self, _widget, _key=None):
         if self.conn:
-            self.mpd.next()
+            self.mpd.call_async('next')
             self.iterate_now()
 
     def on_remove(self, _widget):
@@ -2698,10 +2864,15 @@ class Base:
                                'deletePlaylist', Gtk.ButtonsType.YES_NO) == \
                    Gtk.ResponseType.YES:
                     iters = [model.get_iter(path) for path in selected]
-                    for i in iters:
-                        self.mpd.rm(misc.unescape_html(
-                            self.playlistsdata.get_value(i, 1)))
-                    self.playlists.populate()
+                    names = [misc.unescape_html(
+                        self.playlistsdata.get_value(i, 1)) for i in iters]
+                    def remove_playlists():
+                        with self.mpd.batch() as batch:
+                            for name in names:
+                                batch.rm(name)
+                    self.mpd.run_async(
+                        remove_playlists,
+                        callback=lambda _result: self.playlists.populate())
             elif self.current_tab == self.TAB_STREAMS:
                 treeviewsel = self.streams_selection
                 model, selected = treeviewsel.get_selected_rows()
@@ -2743,20 +2914,20 @@ class Base:
 
     def mpd_clear(self, _widget):
         if self.conn:
-            self.mpd.clear()
+            self.mpd.call_async('clear')
             self.iterate_now()
 
     def on_repeat_clicked(self, widget):
         if self.conn:
-            self.mpd.repeat(int(widget.get_active()))
+            self.mpd.call_async('repeat', int(widget.get_active()))
 
     def on_random_clicked(self, widget):
         if self.conn:
-            self.mpd.random(int(widget.get_active()))
+            self.mpd.call_async('random', int(widget.get_active()))
 
     def on_consume_clicked(self, widget):
         if self.conn:
-            self.mpd.consume(int(widget.get_active()))
+            self.mpd.call_async('consume', int(widget.get_active()))
 
     def setup_prefs_callbacks(self):
         extras = preferences.Extras_cbs
@@ -2851,14 +3022,14 @@ class Base:
 
     def prefs_crossfade_changed(self, crossfade_spin):
         crossfade_value = crossfade_spin.get_value_as_int()
-        self.mpd.crossfade(crossfade_value)
+        self.mpd.call_async('crossfade', crossfade_value)
 
     def prefs_crossfade_toggled(self, button, crossfade_spin):
         crossfade_value = crossfade_spin.get_value_as_int()
         if button.get_active():
-            self.mpd.crossfade(crossfade_value)
+            self.mpd.call_async('crossfade', crossfade_value)
         else:
-            self.mpd.crossfade(0)
+            self.mpd.call_async('crossfade', 0)
 
     def prefs_playback_toggled(self, button):
         self.config.show_playback = button.get_active()
@@ -2952,7 +3123,7 @@ class Base:
             self.tray_icon.hide()
 
     def seek(self, song, seektime):
-        self.mpd.seek(song, seektime)
+        self.mpd.call_async('seek', song, seektime)
         self.iterate_now()
 
     def on_link_click(self, linktype):
@@ -3220,7 +3391,7 @@ class Base:
         self.config.tags_use_mpdpath = use_mpdpath
 
     def tags_mpd_update(self, tag_paths):
-        self.mpd.update(list(tag_paths))
+        self.mpd.run_async(self.mpd.update, list(tag_paths))
         self.mpd_update_queued = True
 
     def on_about(self, _action):
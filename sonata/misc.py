@@ -1,10 +1,12 @@
 
+import functools
 import os
 import subprocess
 import re
 import locale
 import logging
 import sys
+import unicodedata
 
 from gi.repository import GLib
 
@@ -99,21 +101,40 @@ def link_markup(s, enclose_in_parentheses, small, linkcolor):
 def iunique(iterable, key=id):
     seen = set()
     for i in iterable:
-        if key(i) not in seen:
-            seen.add(key(i))
+        k = key(i)
+        if k not in seen:
+            seen.add(k)
             yield i
 
 
+@functools.lru_cache(maxsize=65536)
+def casefold(s):
+    """Return `s` without its differences of case and of Unicode
+    normalization, so that equal tags compare equal in any script."""
+    if s.isascii():
+        return s.lower()
+    return unicodedata.normalize('NFKC',
+                                 unicodedata.normalize('NFKC', s).casefold())
+
+
+def casefold_key(value):
+    """Return a key comparing `value` like casefold(), for strings and for
+    tuples and other iterables of them, such as SongRecords."""
+    if isinstance(value, str):
+        return casefold(value)
+    try:
+        return tuple(casefold_key(item) for item in value)
+    except TypeError:
+        return value
+
+
 def remove_list_duplicates(inputlist, case=True):
     # Note that we can't use list(set(inputlist))
     # because we want the inputlist order preserved.
     if case:
         key = lambda x: x
     else:
-        # repr() allows inputlist to be a list of tuples
-        # FIXME: Doesn't correctly compare uppercase and
-        # lowercase unicode
-        key = lambda x: repr(x).lower()
+        key = casefold_key
     return list(iunique(inputlist, key))
 
 the_re = re.compile('^the ')
@@ -220,10 +241,13 @@ def mpd_env_vars():
     port = None
     password = None
     if 'MPD_HOST' in os.environ:
-        if '@' in os.environ['MPD_HOST']:
-            password, host = os.environ['MPD_HOST'].split('@')
+        # MPD_HOST can be "password@host", where host may be the path of a
+        # unix socket. A leading '@' denotes an abstract socket instead.
+        mpd_host = os.environ['MPD_HOST']
+        if '@' in mpd_host[1:]:
+            password, host = mpd_host.split('@', 1)
         else:
-            host = os.environ['MPD_HOST']
+            host = mpd_host
     if 'MPD_PORT' in os.environ:
         port = int(os.environ['MPD_PORT'])
     return (host, port, password)
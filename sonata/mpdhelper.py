@@ -1,63 +1,904 @@
 
+import collections
+import concurrent.futures
 import functools
 import logging
 import os
+import queue
+import re
 import socket
+import sys
+import threading
+import time
 
+from gi.repository import GLib
 import mpd
 
 from sonata.misc import remove_list_duplicates
 
 
+# Subsystems Sonata reacts to, see the "idle" command of the MPD protocol.
+IDLE_SUBSYSTEMS = ('player', 'mixer', 'options', 'playlist', 'database',
+                   'update', 'stored_playlist')
+
+
+logger = logging.getLogger(__name__)
+
+
+class MPDWorker:
+    """Run functions in a dedicated thread, one after the other.
+
+    MPDClient uses a worker to make sure that only one thread at a time talks
+    to its connection. Functions submitted from the worker thread itself are
+    run immediately, so that a function running in the worker can call other
+    MPD commands.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def in_worker(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, func, *args):
+        """Schedule func(*args) and return a Future for its result"""
+        future = concurrent.futures.Future()
+        if self.in_worker():
+            self._run(future, func, args)
+            return future
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop,
+                                                name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((future, func, args))
+        return future
+
+    def cancel_pending(self):
+        """Cancel the functions which haven't started yet: their futures
+        raise CancelledError."""
+        with self._lock:
+            while True:
+                try:
+                    future, _func, _args = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                future.cancel()
+
+    def _run(self, future, func, args):
+        if future.set_running_or_notify_cancel():
+            self._execute(future, func, args)
+
+    def _execute(self, future, func, args):
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _loop(self):
+        while True:
+            future, func, args = self._queue.get()
+            # A function is either started here or cancelled by
+            # cancel_pending(), not both.
+            with self._lock:
+                started = future.set_running_or_notify_cancel()
+            if started:
+                self._execute(future, func, args)
+
+
+class CommandMetrics:
+    """Statistics about one MPD command, see MPDMetrics"""
+
+    __slots__ = ['calls', 'cache_hits', 'errors', 'fallbacks', 'received',
+                 'total_time', 'max_time', 'histogram', 'callers']
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.received = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.histogram = [0] * (len(MPDMetrics.BUCKETS) + 1)
+        self.callers = collections.Counter()
+
+
+class MPDMetrics:
+    """Statistics about the commands sent to MPD.
+
+    For each command, count the calls, how many were answered from the
+    cache, the errors (and how many of them were replaced by a default
+    value), the data received, the latency and which functions sent it.
+    Run "mpd_metrics.dump()" from the debug shell (sonata --shell), or call
+    the mpd_metrics method over D-Bus, to see them.
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = collections.defaultdict(CommandMetrics)
+
+    def record(self, cmd_name, duration, received=0, error=False,
+               fallback=False, caller=None, cache_hit=False):
+        with self._lock:
+            command = self.commands[cmd_name]
+            command.calls += 1
+            if cache_hit:
+                command.cache_hits += 1
+            command.total_time += duration
+            command.max_time = max(command.max_time, duration)
+            command.received += received
+            if error:
+                command.errors += 1
+            if fallback:
+                command.fallbacks += 1
+            for i, bound in enumerate(self.BUCKETS):
+                if duration < bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            command.histogram[i] += 1
+            if caller is not None:
+                command.callers[caller] += 1
+
+    def dump(self):
+        """Return the statistics as text, slowest commands first"""
+        with self._lock:
+            commands = sorted(self.commands.items(),
+                              key=lambda item: item[1].total_time,
+                              reverse=True)
+            lines = []
+            for cmd_name, command in commands:
+                lines.append(
+                    "%s: %d calls (%d cached), %.3fs total, %.3fs max, "
+                    "%d bytes received, %d errors (%d fallbacks)" % (
+                        cmd_name, command.calls, command.cache_hits,
+                        command.total_time, command.max_time,
+                        command.received, command.errors, command.fallbacks))
+                bounds = ["<%gms" % (bound * 1000) for bound in self.BUCKETS]
+                bounds.append(">=%gms" % (self.BUCKETS[-1] * 1000))
+                lines.append("    latency: " + ", ".join(
+                    "%s: %d" % (bound, count) for bound, count
+                    in zip(bounds, command.histogram) if count))
+                lines.append("    callers: " + ", ".join(
+                    "%s (%d)" % item
+                    for item in command.callers.most_common()))
+        return "\n".join(lines)
+
+
+metrics = MPDMetrics()
+
+
+def find_caller():
+    """Return the function which called into this module, as "file:name" """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return "%s:%s" % (os.path.basename(frame.f_code.co_filename),
+                      frame.f_code.co_name)
+
+
+class MeteredMPDClient(mpd.MPDClient):
+    """python-mpd's client, counting the data it receives"""
+
+    received = 0
+
+    def _read_line(self):
+        line = super()._read_line()
+        if line is not None:
+            self.received += len(line) + 1
+        return line
+
+
+def shutdown_socket(client):
+    """Make the commands of `client` blocked on its socket fail, from any
+    thread. Shutting down a duplicate of the socket affects the connection
+    itself."""
+    try:
+        sock = socket.socket(fileno=os.dup(client.fileno()))
+    except (OSError, mpd.MPDError):
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def call_in_main_loop(future, callback):
+    """Call `callback` with the result of `future` from the GTK main loop"""
+
+    def dispatch(future):
+        if future.cancelled():
+            # Dropped by a disconnection
+            return False
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("Error while running an MPD command")
+        else:
+            callback(result)
+        return False
+
+    future.add_done_callback(lambda future: GLib.idle_add(dispatch, future))
+
+
+class ConnectionPolicy:
+    """How a connection of the pool behaves.
+
+    `timeout` is the socket timeout, in seconds, and `reconnect` tells
+    whether a lost connection should be opened again, and the failed command
+    sent once more, before reporting an error.
+    """
+
+    __slots__ = ['timeout', 'reconnect']
+
+    def __init__(self, timeout, reconnect):
+        self.timeout = timeout
+        self.reconnect = reconnect
+
+
+# Interactive commands (transport, volume, playlist edits...) use the
+# 'control' connection, so that they don't wait behind long queries, which
+# use the 'bulk' connection. The 'idle' connection belongs to MPDIdleListener,
+# which has its own reconnection logic.
+CONNECTION_POLICIES = {
+    'control': ConnectionPolicy(timeout=5, reconnect=True),
+    'bulk': ConnectionPolicy(timeout=60, reconnect=True),
+    'idle': ConnectionPolicy(timeout=None, reconnect=False),
+}
+
+# Commands which may return a lot of data, sent on the 'bulk' connection
+BULK_COMMANDS = {'count', 'find', 'list', 'listall', 'listallinfo',
+                 'listplaylistinfo', 'lsinfo', 'plchanges', 'playlistinfo',
+                 'search', 'stats'}
+
+# Commands which don't change anything, and can be sent again safely
+READ_ONLY_COMMANDS = BULK_COMMANDS | {'currentsong', 'listplaylist',
+                                      'listplaylists', 'ping', 'status'}
+
+# MPD closes the connections unused for a while ('connection_timeout', 60
+# seconds by default). Connections unused for PING_AFTER seconds are checked
+# with 'ping' before sending the other commands, which can't be sent again
+# after a failure since they may have been run.
+PING_AFTER = 30
+
+# Position of the failing command in the error of a command list, e.g.
+# "[50@1] {load} No such playlist"
+COMMAND_LIST_ERROR_RE = re.compile(r'^\[\d+@(\d+)\]')
+
+# Read-only commands whose results only depend on the database, kept in
+# MPDClient's ResultCache
+CACHED_COMMANDS = {'count', 'find', 'list', 'listall', 'listallinfo', 'lsinfo',
+                   'search'}
+
+
+class ResultCache:
+    """Least recently used cache of the results of CACHED_COMMANDS.
+
+    Entries are tagged with the version of MPD's database (the 'db_update'
+    value of the 'stats' command) they were read from. invalidate() should
+    be called when the database changes: the version is then checked again
+    before the next lookup, and the entries of older versions are dropped.
+
+    The cache holds at most `max_entries` results, and about `max_bytes` of
+    data, as received from MPD.
+    """
+
+    def __init__(self, max_entries=5000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.size = 0
+        # (cmd_name, args) -> (version, size, result)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the result cached for `key`, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, result, size):
+        with self._lock:
+            if self.version is None or size > self.max_bytes:
+                return
+            self._remove(key)
+            self._entries[key] = (self.version, size, result)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                  self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def set_version(self, version):
+        with self._lock:
+            self.version = version
+            for key in [key for key, entry in self._entries.items()
+                        if entry[0] != version]:
+                self._remove(key)
+
+    def invalidate(self):
+        with self._lock:
+            self.version = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class MPDConnection:
+    """A connection to MPD, with the worker thread which owns it"""
+
+    def __init__(self, purpose, client):
+        self.purpose = purpose
+        self.policy = CONNECTION_POLICIES[purpose]
+        self.client = client
+        self.client.timeout = self.policy.timeout
+        self.worker = MPDWorker("MPD %s worker" % purpose)
+        # Held by the thread which started a command list until it ends it,
+        # so that commands from other threads don't end up into the list.
+        self.command_list_lock = threading.RLock()
+        self.in_command_list = False
+        self.connected = False
+        self.last_used = 0
+
+
 class MPDClient:
-    def __init__(self, client=None):
+    """Wrap python-mpd's client.
+
+    Sonata talks to MPD through a small pool of connections, one for each
+    kind of traffic (see CONNECTION_POLICIES), never opening more than
+    `max_connections` of them. When the cap is reached, bulk queries share
+    the control connection, and the idle listener isn't started.
+
+    Each connection is owned by a worker thread: commands can be called as
+    usual from any thread, which waits for their result, or be queued with
+    call_async() and run_async() which don't block the caller. This keeps
+    socket I/O out of the GTK main loop.
+    """
+
+    MAX_CONNECTIONS = 3
+    # How long disconnect() waits for the workers to close their connection,
+    # in seconds, before making their pending command fail
+    DISCONNECT_TIMEOUT = 0.5
+    # iterate() passes songs from the worker to the caller by chunks of
+    # ITERATE_CHUNK_SIZE songs, with at most ITERATE_QUEUE_SIZE chunks waiting
+    # to be consumed.
+    ITERATE_CHUNK_SIZE = 100
+    ITERATE_QUEUE_SIZE = 16
+
+    def __init__(self, client=None, max_connections=MAX_CONNECTIONS):
         if client is None:
-            # Yeah, we really want some unicode returned, otherwise we'll have
-            # to do it by ourselves.
-            client = mpd.MPDClient(use_unicode=True)
+            client = self._new_client()
         else:
             client.use_unicode = True
         self._client = client
         self.logger = logging.getLogger(__name__)
+        self.max_connections = max_connections
+        self._connections = {'control': MPDConnection('control', client)}
+        self._idle_listener = None
+        self._host = None
+        self._port = None
+        self._password = None
+        self._mpd_version = (0, 0, 0)
+        # The connection on which the current thread opened a command list
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.cache = ResultCache()
+        self._cache_address = None
+
+    def _new_client(self):
+        # Yeah, we really want some unicode returned, otherwise we'll have
+        # to do it by ourselves.
+        return MeteredMPDClient(use_unicode=True)
 
     def __getattr__(self, attr):
         """
         Wraps all calls from mpd client into a proper function,
         which catches all MPDClient related exceptions and log them.
         """
-        cmd = getattr(self._client, attr)
+        if not hasattr(self._client, attr):
+            raise AttributeError(attr)
         # save result, so function have to be constructed only once
-        wrapped_cmd = functools.partial(self._call, cmd, attr)
+        wrapped_cmd = functools.partial(self._call_sync, attr)
         setattr(self, attr, wrapped_cmd)
         return wrapped_cmd
 
-    def _call(self, cmd, cmd_name, *args):
+    def _connection(self, purpose=None, cmd_name=None):
+        """Return the connection to use from the current thread"""
+        for connection in list(self._connections.values()):
+            if connection.worker.in_worker():
+                return connection
+        connection = getattr(self._local, 'command_list', None)
+        if connection is not None:
+            return connection
+        if purpose is None:
+            purpose = 'bulk' if cmd_name in BULK_COMMANDS else 'control'
+        with self._lock:
+            if purpose not in self._connections:
+                if purpose != 'bulk' or \
+                   self._count_connections() >= self.max_connections:
+                    purpose = 'control'
+                else:
+                    self._connections[purpose] = MPDConnection(
+                        purpose, self._new_client())
+            return self._connections[purpose]
+
+    def _count_connections(self):
+        count = len(self._connections)
+        if self._idle_listener is not None:
+            count += 1
+        return count
+
+    def _submit(self, connection, func, *args):
+        if connection.worker.in_worker():
+            return connection.worker.submit(func, *args)
+        with connection.command_list_lock:
+            return connection.worker.submit(func, *args)
+
+    def _call_sync(self, cmd_name, *args):
+        connection = self._connection(cmd_name=cmd_name)
+        in_worker = connection.worker.in_worker()
+        if cmd_name == 'command_list_ok_begin' and not in_worker:
+            connection.command_list_lock.acquire()
+            self._local.command_list = connection
         try:
-            retval = cmd(*args)
+            return self._submit(connection, self._call, connection,
+                                find_caller(), cmd_name, *args).result()
+        finally:
+            if cmd_name == 'command_list_end' and not in_worker:
+                self._local.command_list = None
+                connection.command_list_lock.release()
+
+    def call_async(self, cmd_name, *args, callback=None):
+        """Queue the `cmd_name` command and return a Future for its result.
+
+        If `callback` is given, it is called with the result from the GTK
+        main loop.
+        """
+        connection = self._connection(cmd_name=cmd_name)
+        future = self._submit(connection, self._call, connection,
+                              find_caller(), cmd_name, *args)
+        if callback is not None:
+            call_in_main_loop(future, callback)
+        return future
+
+    def run_async(self, func, *args, callback=None, purpose='control'):
+        """Run func(*args) in the worker thread of the `purpose` connection,
+        see call_async().
+
+        This is meant for functions sending several commands, which can call
+        the methods of this client as usual: they are all sent on the same
+        connection.
+        """
+        connection = self._connection(purpose)
+        future = self._submit(connection, func, *args)
+        if callback is not None:
+            call_in_main_loop(future, callback)
+        return future
+
+    def iterate(self, cmd_name, *args):
+        """Return an iterator over the songs returned by `cmd_name`.
+
+        Songs are parsed while the response is being received, without
+        building a list of all of them first, so the caller can start using
+        them early, or stop before the end. Errors are logged and raised
+        (socket.error or mpd.MPDError): the songs already returned are then
+        only a part of the result.
+        """
+        connection = self._connection(cmd_name=cmd_name)
+        caller = find_caller()
+        if connection.worker.in_worker():
+            return self._iterate(connection, caller, cmd_name, args)
+        else:
+            return self._iterate_from_worker(connection, caller, cmd_name,
+                                             args)
+
+    def _iterate(self, connection, caller, cmd_name, args):
+        complete = False
+        start = time.perf_counter()
+        received = self._received(connection)
+        try:
+            connection.client.iterate = True
+            try:
+                items = self._send(connection, cmd_name, *args)
+            finally:
+                connection.client.iterate = False
+            for item in items:
+                yield MPDSong(item)
+            complete = True
         except (socket.error, mpd.MPDError) as e:
-            if cmd_name in ['lsinfo', 'list']:
-                # return sane values, which could be used afterwards
-                return []
-            elif cmd_name == 'status':
-                return {}
-            else:
-                self.logger.error("%s", e)
+            self.logger.error("%s", e)
+            raise
+        finally:
+            metrics.record(cmd_name, time.perf_counter() - start,
+                           self._received(connection) - received,
+                           error=not complete, caller=caller)
+            if not complete:
+                # The rest of the response is still waiting to be read, it's
+                # cheaper to open the connection again when needed.
+                self._disconnect(connection)
+
+    def _iterate_from_worker(self, connection, caller, cmd_name, args):
+        chunks = queue.Queue(self.ITERATE_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(chunk):
+            while not stopped.is_set():
+                try:
+                    chunks.put(chunk, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            items = self._iterate(connection, caller, cmd_name, args)
+            chunk = []
+            end = None
+            try:
+                for item in items:
+                    chunk.append(item)
+                    if len(chunk) == self.ITERATE_CHUNK_SIZE:
+                        put(chunk)
+                        chunk = []
+                    if stopped.is_set():
+                        break
+                put(chunk)
+            except (socket.error, mpd.MPDError) as e:
+                # Raised again by the caller's thread
+                end = e
+            finally:
+                items.close()
+                put(end)
+
+        self._submit(connection, produce)
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+        finally:
+            stopped.set()
+
+    def command_list_async(self, commands, callback=None):
+        """Send `commands`, a list of (cmd_name, args) tuples, as a command
+        list from the worker thread, see call_async().
+        """
+        def run():
+            self.command_list_ok_begin()
+            for cmd_name, args in commands:
+                getattr(self, cmd_name)(*args)
+            return self.command_list_end()
+        return self.run_async(run, callback=callback)
+
+    def connect(self, host, port):
+        # The host can be the path of MPD's unix socket
+        host = os.path.expanduser(host)
+        self._host, self._port = host, port
+        if self._cache_address != (host, port):
+            self.cache.clear()
+            self._cache_address = (host, port)
+        self.cache.invalidate()
+        # The other connections will be opened again when needed
+        for connection in list(self._connections.values()):
+            if connection.purpose != 'control':
+                self._submit(connection, self._disconnect, connection)
+        return self._call_sync('connect', host, port)
+
+    def password(self, password):
+        self._password = password
+        return self._call_sync('password', password)
+
+    def disconnect(self):
+        # The queued commands would be sent without a connection
+        for connection in list(self._connections.values()):
+            connection.worker.cancel_pending()
+        self._host = self._port = self._password = None
+        self._mpd_version = (0, 0, 0)
+        if self._idle_listener is not None:
+            self._idle_listener.stop()
+            self._idle_listener = None
+        # Don't wait for a command stuck on its socket from the main loop:
+        # the socket is shut down, and the worker closes the connection once
+        # the command failed.
+        connections = list(self._connections.values())
+        futures = [self._submit(connection, self._disconnect, connection)
+                   for connection in connections]
+        concurrent.futures.wait(futures, timeout=self.DISCONNECT_TIMEOUT)
+        for connection, future in zip(connections, futures):
+            if not future.done():
+                self.logger.debug("Interrupting the %s connection",
+                                  connection.purpose)
+                shutdown_socket(connection.client)
+
+    def _disconnect(self, connection):
+        connection.connected = False
+        connection.in_command_list = False
+        try:
+            connection.client.disconnect()
+        except (socket.error, mpd.MPDError):
+            pass
+
+    def invalidate_cache(self):
+        """To be called when MPD's database changed"""
+        self.cache.invalidate()
+
+    def _cache_get(self, connection, cmd_name, args):
+        # Run from the worker of the connection
+        if cmd_name not in CACHED_COMMANDS or connection.in_command_list:
+            return None
+        if self.cache.version is None:
+            try:
+                stats = self._send(connection, 'stats')
+            except (socket.error, mpd.MPDError):
                 return None
+            self.cache.set_version(stats.get('db_update'))
+        result = self.cache.get((cmd_name,) + args)
+        if isinstance(result, list):
+            # Callers may modify the lists they get
+            result = list(result)
+        return result
+
+    def _cache_put(self, cmd_name, args, result, size):
+        if cmd_name in CACHED_COMMANDS:
+            if isinstance(result, list):
+                result = list(result)
+            self.cache.put((cmd_name,) + args, result, size)
+
+    def start_idle_listener(self, listener):
+        """Start `listener` on its own connection, if the cap allows it.
+
+        Return whether the listener was started; if it wasn't, the changes
+        have to be polled for.
+        """
+        if self._idle_listener is not None:
+            self._idle_listener.stop()
+            self._idle_listener = None
+        if self._count_connections() >= self.max_connections:
+            return False
+        self._idle_listener = listener
+        listener.start(self._host, self._port, self._password)
+        return True
+
+    def _open(self, connection):
+        # Run from the worker of the connection
+        self._disconnect(connection)
+        connection.client.connect(self._host, self._port)
+        if self._password:
+            connection.client.password(self._password)
+        connection.connected = True
+        connection.last_used = time.monotonic()
+        self._set_version(connection.client)
+
+    def _set_version(self, client):
+        # Kept from the last connection, since the version of a client is
+        # reset when it is disconnected.
+        try:
+            self._mpd_version = tuple(int(part) for part in
+                                      client.mpd_version.split("."))
+        except (AttributeError, ValueError):
+            pass
+
+    def batch(self, purpose=None):
+        """Return a MPDBatch sending its commands on the `purpose`
+        connection, or on the bulk one if it contains any bulk command.
+        """
+        return MPDBatch(self, purpose, find_caller())
 
+    def send_batch(self, commands, purpose=None, caller=None):
+        """Send `commands`, a list of (cmd_name, args, future) tuples, in
+        command lists, and set the result of each future.
+        """
+        if purpose is None and any(cmd_name in BULK_COMMANDS
+                                   for cmd_name, _args, _f in commands):
+            purpose = 'bulk'
+        connection = self._connection(purpose)
+        self._submit(connection, self._send_batch, connection, caller,
+                     commands).result()
+
+    def _send_batch(self, connection, caller, commands):
+        pending = []
+        for cmd_name, args, future in commands:
+            result = self._cache_get(connection, cmd_name, args)
+            if result is None:
+                pending.append((cmd_name, args, future))
+            else:
+                metrics.record(cmd_name, 0, caller=caller, cache_hit=True)
+                future.set_result(result)
+        commands = pending
+
+        for i in range(0, len(commands), MPDBatch.SIZE):
+            chunk = commands[i:i + MPDBatch.SIZE]
+            start = time.perf_counter()
+            received = self._received(connection)
+            try:
+                self._send(connection, 'command_list_ok_begin')
+                for cmd_name, args, _future in chunk:
+                    self._send(connection, cmd_name, *args)
+                results = self._send(connection, 'command_list_end')
+            except (socket.error, mpd.MPDError) as e:
+                self.logger.debug("Command list failed: %s", e)
+                self._send_batch_failed(connection, caller, chunk, e)
+            else:
+                # The time and data of the list are shared among its
+                # commands.
+                duration = (time.perf_counter() - start) / len(chunk)
+                received = (self._received(connection) - received) // \
+                        len(chunk)
+                for (cmd_name, args, future), retval in zip(chunk, results):
+                    metrics.record(cmd_name, duration, received,
+                                   caller=caller)
+                    result = self._convert(cmd_name, args, retval)
+                    self._cache_put(cmd_name, args, result, received)
+                    future.set_result(result)
+
+    def _send_batch_failed(self, connection, caller, chunk, error):
+        # MPD stops at the first failing command of a list, and tells which
+        # one it is: the commands before it were run, and must not be sent
+        # again unless they are read-only, but their results are lost.
+        match = None
+        if isinstance(error, mpd.CommandError):
+            match = COMMAND_LIST_ERROR_RE.match(str(error))
+        if match is None:
+            # The connection was lost: we don't know which commands were run
+            failed = len(chunk)
+        else:
+            failed = int(match.group(1))
+        for i, (cmd_name, args, future) in enumerate(chunk):
+            if i > failed or (i < failed and cmd_name in READ_ONLY_COMMANDS):
+                future.set_result(self._call(connection, caller, cmd_name,
+                                             *args))
+            elif i < failed:
+                future.set_result(None)
+            else:
+                metrics.record(cmd_name, 0, error=True, caller=caller)
+                future.set_result(self._error_result(cmd_name, error)[0])
+
+    def _error_result(self, cmd_name, error):
+        # Return the value standing for the result of a failed command, and
+        # whether it can be used as such
+        if cmd_name in ['lsinfo', 'list']:
+            # return sane values, which could be used afterwards
+            return [], True
+        elif cmd_name == 'status':
+            return {}, True
+        self.logger.error("%s", error)
+        return None, False
+
+    def _received(self, connection):
+        return getattr(connection.client, 'received', 0)
+
+    def _call(self, connection, caller, cmd_name, *args):
+        result = self._cache_get(connection, cmd_name, args)
+        if result is not None:
+            metrics.record(cmd_name, 0, caller=caller, cache_hit=True)
+            return result
+
+        start = time.perf_counter()
+        received = self._received(connection)
+        error = fallback = False
+        try:
+            retval = self._send(connection, cmd_name, *args)
+        except (socket.error, mpd.MPDError) as e:
+            error = True
+            result, fallback = self._error_result(cmd_name, e)
+            return result
+        finally:
+            received = self._received(connection) - received
+            metrics.record(cmd_name, time.perf_counter() - start, received,
+                           error, fallback, caller)
+        result = self._convert(cmd_name, args, retval)
+        self._cache_put(cmd_name, args, result, received)
+        return result
+
+    def _convert(self, cmd_name, args, retval):
         if cmd_name in ['songinfo', 'currentsong']:
             return MPDSong(retval)
         elif cmd_name in ['plchanges', 'search']:
             return [MPDSong(s) for s in retval]
+        elif cmd_name in ['count'] and 'group' in args[-2:-1]:
+            return MPDCount.groups(retval, args[-1])
         elif cmd_name in ['count']:
             return MPDCount(retval)
         else:
             return retval
 
+    def _send(self, connection, cmd_name, *args):
+        if cmd_name == 'connect':
+            self._disconnect(connection)
+            connection.client.connect(*args)
+            connection.connected = True
+            connection.last_used = time.monotonic()
+            self._set_version(connection.client)
+            return None
+        elif cmd_name == 'disconnect':
+            return self._disconnect(connection)
+
+        can_reconnect = connection.policy.reconnect and \
+                not connection.in_command_list and \
+                cmd_name != 'command_list_end' and self._host is not None
+        if not connection.connected and can_reconnect:
+            # Connections other than the control one are opened lazily
+            self._open(connection)
+        elif can_reconnect and cmd_name not in READ_ONLY_COMMANDS and \
+             time.monotonic() - connection.last_used > PING_AFTER:
+            self._send(connection, 'ping')
+
+        cmd = getattr(connection.client, cmd_name)
+        try:
+            retval = cmd(*args)
+        except (socket.error, mpd.ConnectionError) as e:
+            connection.connected = False
+            connection.in_command_list = False
+            if not can_reconnect or cmd_name not in READ_ONLY_COMMANDS:
+                # The connection is opened again by the next command
+                raise
+            self.logger.debug("Reconnecting to MPD (%s): %s",
+                              connection.purpose, e)
+            self._open(connection)
+            retval = cmd(*args)
+        finally:
+            connection.last_used = time.monotonic()
+            if cmd_name == 'command_list_end':
+                connection.in_command_list = False
+
+        if cmd_name == 'command_list_ok_begin':
+            connection.in_command_list = True
+        return retval
+
+    @property
+    def uses_unix_socket(self):
+        """Whether we are connected through a unix socket, which lets us add
+        local files to the playlist.
+        """
+        return self._host is not None and self._host.startswith(('/', '@'))
+
+    @property
+    def address(self):
+        """The (host, port) of the server we are connected to."""
+        return self._host, self._port
+
     @property
     def version(self):
-        return tuple(int(part) for part in self._client.mpd_version.split("."))
+        """The version of the server, as a tuple of ints, or (0, 0, 0) when
+        not connected."""
+        return self._mpd_version
 
     def update(self, paths):
+        connection = self._connection('control')
+        return self._submit(connection, self._update, connection,
+                            paths).result()
+
+    def _update(self, connection, paths):
         if mpd_is_updating(self.status()):
             return
 
@@ -68,10 +909,184 @@ class MPDClient:
             dirs.append(os.path.dirname(path))
         dirs = remove_list_duplicates(dirs, True)
 
-        self._client.command_list_ok_begin()
+        connection.client.command_list_ok_begin()
         for directory in dirs:
-            self._client.update(directory)
-        self._client.command_list_end()
+            connection.client.update(directory)
+        connection.client.command_list_end()
+
+
+class MPDBatch:
+    """Collect MPD commands, to be sent together in command lists.
+
+    Commands are called as methods of the batch, and return Futures which
+    are set once the commands have been sent, when leaving the `with` block:
+
+        with client.batch() as batch:
+            counts = [batch.count('artist', artist) for artist in artists]
+        songs = sum(count.result().songs for count in counts)
+
+    This saves a round trip to the server for each command. Like with
+    MPDClient, errors are logged and the results are then None, or sane
+    default values. The commands which may have been run before an error
+    are not sent again, unless they are read-only.
+    """
+
+    # Maximum number of commands in each command list
+    SIZE = 500
+
+    def __init__(self, client, purpose=None, caller=None):
+        self._client = client
+        self._purpose = purpose
+        self._caller = caller
+        self._commands = []
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def queue_command(*args):
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            self._commands.append((attr, args, future))
+            return future
+        return queue_command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc_value, _traceback):
+        commands, self._commands = self._commands, []
+        if exc_type is None and commands:
+            self._client.send_batch(commands, self._purpose, self._caller)
+        return False
+
+
+class MPDIdleListener:
+    """Wait for changes on the MPD server using the 'idle' command.
+
+    A connection waiting in 'idle' can't be used for anything else, so the
+    listener owns a dedicated connection, running in its own thread. Each
+    time MPD reports changes, `callback` is called from the GTK main loop
+    with the set of subsystems which changed.
+
+    If the connection is lost, the listener tries to reconnect after
+    RETRY_DELAY_MIN seconds, doubling the delay after each failure up to
+    RETRY_DELAY_MAX, and reports all the subsystems as changed once it is
+    back, since we may have missed some events in between. The database is
+    only reported if its 'db_update' stat changed meanwhile, since reloading
+    the library is costly.
+    """
+
+    RETRY_DELAY_MIN = 1
+    RETRY_DELAY_MAX = 60
+    # Leave 'idle' after this many seconds without events, and enter it
+    # again. A connection which doesn't answer within PING_TIMEOUT is dead.
+    IDLE_TIMEOUT = 300
+    PING_TIMEOUT = 10
+
+    def __init__(self, callback, subsystems=IDLE_SUBSYSTEMS):
+        self.callback = callback
+        self.subsystems = subsystems
+        self.logger = logging.getLogger(__name__)
+        self.active = False
+        self._client = None
+        self._stopped = None
+
+    def start(self, host, port, password):
+        self.stop()
+        self._stopped = threading.Event()
+        self._client = mpd.MPDClient()
+        self._client.timeout = CONNECTION_POLICIES['idle'].timeout
+        self._client.idletimeout = self.IDLE_TIMEOUT + self.PING_TIMEOUT
+        thread = threading.Thread(target=self._loop,
+                                  args=(self._client, self._stopped,
+                                        host, port, password))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._stopped is None:
+            return
+        self._stopped.set()
+        self.active = False
+        # Wake up the listener thread, blocked in 'idle'
+        shutdown_socket(self._client)
+        self._client = None
+        self._stopped = None
+
+    def _loop(self, client, stopped, host, port, password):
+        reconnecting = False
+        delay = self.RETRY_DELAY_MIN
+        db_update = None
+        while not stopped.is_set():
+            try:
+                client.connect(host, port)
+                if password:
+                    client.password(password)
+                self.active = True
+                delay = self.RETRY_DELAY_MIN
+                last_db_update = db_update
+                db_update = client.stats().get('db_update')
+                if reconnecting:
+                    changed = set(self.subsystems)
+                    if db_update == last_db_update:
+                        changed.discard('database')
+                    self._notify(stopped, changed)
+                while not stopped.is_set():
+                    changed = set(self._idle(client))
+                    if not changed:
+                        # Woken up by 'noidle'
+                        continue
+                    if 'database' in changed:
+                        db_update = client.stats().get('db_update')
+                    self._notify(stopped, changed)
+            except (socket.error, mpd.MPDError, ValueError) as e:
+                self.active = False
+                if stopped.is_set():
+                    break
+                self.logger.debug("Idle connection lost: %s", e)
+            try:
+                client.disconnect()
+            except (socket.error, mpd.MPDError):
+                pass
+            reconnecting = True
+            stopped.wait(delay)
+            delay = min(delay * 2, self.RETRY_DELAY_MAX)
+        self.active = False
+        try:
+            client.disconnect()
+        except (socket.error, mpd.MPDError):
+            pass
+
+    def _idle(self, client):
+        # python-mpd2 can't leave 'idle' by itself, and a socket which timed
+        # out can't be read anymore: 'noidle' is sent from another thread,
+        # and MPD ignores it if 'idle' returned meanwhile.
+        timer = threading.Timer(self.IDLE_TIMEOUT, self._noidle, (client,))
+        timer.daemon = True
+        timer.start()
+        try:
+            return client.idle(*self.subsystems)
+        finally:
+            timer.cancel()
+
+    def _noidle(self, client):
+        try:
+            sock = socket.socket(fileno=os.dup(client.fileno()))
+        except (OSError, mpd.MPDError):
+            return
+        try:
+            sock.sendall(b'noidle\n')
+        except OSError:
+            pass
+        sock.close()
+
+    def _notify(self, stopped, changed):
+        def dispatch():
+            if not stopped.is_set():
+                self.callback(changed)
+            return False
+        GLib.idle_add(dispatch)
 
 
 class MPDCount:
@@ -83,12 +1098,42 @@ class MPDCount:
         self.playtime = int(m['playtime'])
         self.songs = int(m['songs'])
 
+    @classmethod
+    def groups(cls, m, tag):
+        """Return a {value: MPDCount} dict from the result of a
+        'count ... group tag' command (MPD 0.21+)."""
+        values = m.get(tag.lower(), [])
+        if not isinstance(values, list):
+            # Only one group was found
+            return {values: cls(m)}
+        playtimes = m.get('playtime', [])
+        songs = m.get('songs', [])
+        return {value: cls({'playtime': playtime, 'songs': num_songs})
+                for value, playtime, num_songs in zip(values, playtimes,
+                                                      songs)}
+
 
 class MPDSong:
-    """Provide information about a song in a convenient format"""
+    """Provide information about a song in a convenient format
+
+    Sonata keeps many songs in memory (the current playlist, search
+    results...), so they are stored compactly: the common tags have their
+    own slot, the others go into a dictionary created only when needed.
+    Values which are shared by many songs, like artists or albums, are
+    interned so that each of them is stored only once.
+    """
+
+    # Tags stored in slots, named after the tag with a leading underscore.
+    TAGS = ('file', 'artist', 'album', 'albumartist', 'title', 'track',
+            'disc', 'date', 'genre', 'composer', 'name', 'time', 'pos', 'id')
+    INTERNED_TAGS = frozenset(['artist', 'album', 'albumartist', 'date',
+                               'genre', 'composer'])
+    _SLOTS = {tag: '_' + tag for tag in TAGS}
+
+    __slots__ = list(_SLOTS.values()) + ['_extra']
 
     def __init__(self, mapping):
-        self._mapping = {}
+        self._extra = None
         for key, value in mapping.items():
             # Some attributes may be present several times, which is translated
             # into a list of values by python-mpd. We keep only the first one,
@@ -96,17 +1141,44 @@ class MPDSong:
             # moment.
             if isinstance(value, list):
                 value = value[0]
-            self._mapping[key] = value
+            slot = self._SLOTS.get(key)
+            if slot is None:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[sys.intern(key)] = value
+            else:
+                if key in self.INTERNED_TAGS:
+                    value = sys.intern(value)
+                setattr(self, slot, value)
+
+    def _raw(self, key, alt=None):
+        # Return the value of `key`, as sent by MPD
+        slot = self._SLOTS.get(key)
+        if slot is not None:
+            value = getattr(self, slot, None)
+        elif self._extra is not None:
+            value = self._extra.get(key)
+        else:
+            value = None
+        return alt if value is None else value
+
+    def items(self):
+        for tag, slot in self._SLOTS.items():
+            value = getattr(self, slot, None)
+            if value is not None:
+                yield tag, value
+        if self._extra is not None:
+            yield from self._extra.items()
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and \
-                self._mapping == other._mapping
+                dict(self.items()) == dict(other.items())
 
     def __ne__(self, other):
         return not (self == other)
 
     def __contains__(self, key):
-        return key in self._mapping
+        return self._raw(key) is not None
 
     def __getitem__(self, key):
         if key not in self:
@@ -114,44 +1186,60 @@ class MPDSong:
         return self.get(key)
 
     def get(self, key, alt=None):
-        if key in self._mapping and hasattr(self, key):
+        if key in self and hasattr(self, key):
             return getattr(self, key)
         else:
-            return self._mapping.get(key, alt)
+            return self._raw(key, alt)
 
     def __getattr__(self, attr):
-        # Get the attribute's value directly into the internal mapping.
-        # This function is not called if the current object has a "real"
-        # attribute set.
-        return self._mapping.get(attr)
+        # Get the attribute's value directly from the tags. This function is
+        # not called if the current object has a "real" attribute set.
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return self._raw(attr)
 
     def values(self):
-        return self._mapping.values()
+        return [value for _key, value in self.items()]
 
     @property
     def id(self):
-        return int(self._mapping.get('id', 0))
+        return int(self._raw('id', 0))
 
     @property
     def track(self):
-        return cleanup_numeric(self._mapping.get('track', '0'))
+        return cleanup_numeric(self._raw('track', '0'))
 
     @property
     def pos(self):
-        v = self._mapping.get('pos', '0')
+        v = self._raw('pos', '0')
         return int(v) if v.isdigit() else 0
 
     @property
     def time(self):
-        return int(self._mapping.get('time', 0))
+        return int(self._raw('time', 0))
 
     @property
     def disc(self):
-        return cleanup_numeric(self._mapping.get('disc', 0))
+        return cleanup_numeric(self._raw('disc', 0))
 
     @property
     def file(self):
-        return self._mapping.get('file', '') # XXX should be always here?
+        return self._raw('file', '') # XXX should be always here?
+
+def filter_expression(tags):
+    """Return a filter expression (MPD 0.21+) matching the songs whose tags
+    have the given values, `tags` being a list of (tag, value) pairs.
+
+    Used with 'search', values are compared without regard to case, and an
+    empty value matches the songs which don't have the tag.
+    """
+    conditions = []
+    for tag, value in tags:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        conditions.append('(%s == "%s")' % (tag, value))
+    if len(conditions) == 1:
+        return conditions[0]
+    return '(%s)' % ' AND '.join(conditions)
 
 def cleanup_numeric(value):
     # track and disc can be oddly formatted (eg, '4/10')
@@ -1,11 +1,17 @@
 #!/usr/bin/python
 
 import doctest
+import functools
 import unittest
+import unittest.mock
 import gettext
 import os
+import socket
 import sys
 import operator
+import tempfile
+import time
+import threading
 
 # This currently needed, because gettext is used in some module, i want to test
 try:
@@ -14,8 +20,12 @@ except:
     gettext.install('sonata', '/usr/share/locale')
     gettext.textdomain('sonata')
 
-from sonata import misc, song, library
-from sonata.mpdhelper import MPDSong
+import mpd
+
+from sonata import misc, song, library, current, mpdhelper
+from sonata.libraryindex import LibraryIndex
+from sonata.mpdhelper import MPDClient, MPDCount, MPDIdleListener, \
+        MPDSong, MPDWorker, IDLE_SUBSYSTEMS, metrics, filter_expression
 
 DOCTEST_FLAGS = (
     doctest.ELLIPSIS |
@@ -61,6 +71,18 @@ class TestSonata(unittest.TestCase):
         self.assertEqual(record_equal.genre, c)
         self.assertEqual(record_equal.path, e)
 
+    def test_remove_list_duplicates(self):
+        tags = ['Straße', 'STRASSE', 'Café', 'Cafe\u0301', 'Ёлка', 'ёлка',
+                'ﾊﾟﾝ', 'パン']
+        self.assertEqual(misc.remove_list_duplicates(tags, case=False),
+                         ['Straße', 'Café', 'Ёлка', 'ﾊﾟﾝ'])
+        self.assertEqual(misc.remove_list_duplicates(tags), tags)
+        records = [song.SongRecord(artist='Ёлка', album='A'),
+                   song.SongRecord(artist='ёлка', album='a'),
+                   ('Ёлка', 1), ('ЁЛКА', 1)]
+        self.assertEqual(misc.remove_list_duplicates(records, case=False),
+                         [records[0], records[2]])
+
     def test_list_identfy_VA_albums(self):
         # Test multiple arguments
         data  = [("artist1", "album1", "/",   2006),
@@ -70,8 +92,23 @@ class TestSonata(unittest.TestCase):
         albums = [song.SongRecord(artist=item[0], album=item[1],
                                   path=item[2], year=item[3]) for item in data]
         various_albums = library.list_mark_various_artists_albums(albums)
-        albums[0].artist = library.VARIOUS_ARTISTS
-        self.assertEqual(various_albums, albums)
+        self.assertEqual(various_albums, [
+            song.SongRecord(artist=library.VARIOUS_ARTISTS, album="album1",
+                            path="/", year=2006),
+            albums[2]])
+
+        # Rows of the same album and artist are merged, whatever their case
+        albums3 = [song.SongRecord(artist="artist1", album="album1"),
+                   song.SongRecord(artist="ARTIST1", album="Album1")]
+        various_albums3 = library.list_mark_various_artists_albums(albums3)
+        self.assertEqual(various_albums3, albums3[:1])
+
+        # Without their path, albums of different artists are kept apart
+        albums4 = [song.SongRecord(artist="artist1", album="Greatest Hits"),
+                   song.SongRecord(artist="artist2", album="Greatest Hits"),
+                   song.SongRecord(artist="Artist2", album="greatest hits")]
+        various_albums4 = library.list_mark_various_artists_albums(albums4)
+        self.assertEqual(various_albums4, albums4[:2])
 
         # Test single argument
         albums2 = [song.SongRecord(artist="Tim Pritlove, Holger Klein", album="Not Safe For Work", path="podcasts/Not Save For Work", year=2012)]
@@ -79,6 +116,200 @@ class TestSonata(unittest.TestCase):
         self.assertEqual(various_albums2, albums2)
 
 
+    def test_remove_covered_rows(self):
+        SongRecord = song.SongRecord
+        rows = [(False, SongRecord(artist='Foo')),
+                (False, SongRecord(artist='foo', album='A')),
+                (False, SongRecord(artist='Bar', album='A', year='2000')),
+                (False, SongRecord(artist=library.VARIOUS_ARTISTS,
+                                   album='B')),
+                (False, SongRecord(artist='Bar', album='B')),
+                (False, SongRecord(artist='Bar', album='A', year='2000')),
+                (False, SongRecord(path='a')),
+                (True, SongRecord(path='a/b/1')),
+                (False, SongRecord(path='a/b')),
+                (True, SongRecord(path='c/1'))]
+        self.assertEqual([rows[i] for i in (0, 2, 3, 6, 9)],
+                         library.remove_covered_rows(rows))
+
+
+class TestLibrary(unittest.TestCase):
+    def test_compose_single(self):
+        fake = unittest.mock.MagicMock()
+        fake.NOTAG = 'Untagged'
+        fake.library_return_list_items.return_value = ['Foo', 'FOO', 'Bar']
+        compose = library.Library.library_compose_list_count_searchlist_single
+        # Cache miss: the map is built from the tag values
+        s, cached_map = compose(fake, 'foo', 'artist', None, [])
+        self.assertEqual([('artist', 'Foo'), ('artist', 'FOO')], s)
+        self.assertEqual({'': [''], 'foo': ['Foo', 'FOO'], 'bar': ['Bar']},
+                         cached_map)
+        # Cache hit: MPD isn't queried again
+        fake.library_return_list_items.reset_mock()
+        s, cached_map2 = compose(fake, 'BAR', 'artist', cached_map,
+                                 [('genre', 'Rock')])
+        self.assertEqual([('genre', 'Rock', 'artist', 'Bar')], s)
+        self.assertIs(cached_map, cached_map2)
+        fake.library_return_list_items.assert_not_called()
+        self.assertEqual((None, cached_map),
+                         compose(fake, 'Baz', 'artist', cached_map, []))
+
+    def test_grouped_albums(self):
+        fake = unittest.mock.MagicMock()
+        fake.NOTAG = 'Untagged'
+        fake.library_index_get.return_value = None
+        fake.mpd.version = (0, 21, 0)
+        fake.mpd.list.return_value = [
+            {'album': 'Hits', 'artist': 'a', 'date': '2000'},
+            {'album': 'Hits', 'artist': 'b', 'date': '2000'},
+            {'album': 'Hits', 'artist': 'c', 'date': '2000'},
+            {'album': 'Solo', 'artist': 'a', 'date': '2001'}]
+        # The songs of a and b are in the same directory
+        paths = {'a': 'comp', 'b': 'comp', 'c': 'c/hits'}
+        fake.library_album_paths.side_effect = lambda albums: [
+            paths[album.artist] for album in albums]
+        fake.library_return_album_counts.side_effect = lambda albums: [
+            (10, 1)] * len(albums)
+        fake.library_albums_set_paths = functools.partial(
+            library.Library.library_albums_set_paths, fake)
+        bd = library.Library.library_populate_toplevel_data(fake,
+                                                            albumview=True)
+        self.assertEqual([('Hits', library.VARIOUS_ARTISTS, 'comp'),
+                          ('Hits', 'c', 'c/hits'), ('Solo', 'a', None),
+                          ('Untagged', None, None)],
+                         [(row[1].album, row[1].artist, row[1].path)
+                          for _sort, row in bd])
+        # Only the paths of the ambiguous albums were looked for
+        self.assertEqual(3, len(fake.library_album_paths.call_args[0][0]))
+
+    def test_index_retry(self):
+        fake = unittest.mock.MagicMock()
+        fake.library_index_get.return_value = None
+        fake.library_index_id = fake.library_index_building = 1
+        fake.library_index_retry = None
+        fake.library_index_failures = 0
+        wanted = functools.partial(library.Library.library_index_wanted, fake)
+        self.assertFalse(wanted())
+        library.Library.library_index_scan_failed(fake, 1)
+        self.assertIsNone(fake.library_index_building)
+        # Not on the next browse, but after a while or once the database
+        # changed
+        self.assertFalse(wanted())
+        with unittest.mock.patch('time.monotonic',
+                                 return_value=time.monotonic() + 61):
+            self.assertTrue(wanted())
+        fake.library_index_id = 2
+        self.assertTrue(wanted())
+        library.Library.library_index_scan_failed(fake, 2)
+        with unittest.mock.patch('time.monotonic',
+                                 return_value=time.monotonic() + 61):
+            self.assertFalse(wanted())
+
+    def test_browse_cache(self):
+        fake = unittest.mock.MagicMock()
+        fake.library_browse_id = 1
+        fake.config.lib_view = 'artist'
+        fake.library_views = mpdhelper.ResultCache()
+        fake.library_views.set_version(1)
+        wd = song.SongRecord(artist='Foo')
+        result = (wd, [(None, [None, wd, 'Foo'])])
+        browse_done = library.Library.library_browse_done
+        # The view was changed while the rows were read
+        fake.config.lib_view = 'genre'
+        browse_done(fake, 1, ('artist', wd, 1), False, [], False, False,
+                    result)
+        self.assertIsNone(fake.library_views.get(('artist', wd)))
+        # The database changed
+        fake.config.lib_view = 'artist'
+        fake.library_views.set_version(2)
+        browse_done(fake, 1, ('artist', wd, 1), False, [], False, False,
+                    result)
+        self.assertIsNone(fake.library_views.get(('artist', wd)))
+        # Another level was browsed
+        browse_done(fake, 0, ('artist', wd, 2), False, [], False, False,
+                    result)
+        self.assertIsNone(fake.library_views.get(('artist', wd)))
+        browse_done(fake, 1, ('artist', wd, 2), False, [], False, False,
+                    result)
+        self.assertIs(result, fake.library_views.get(('artist', wd)))
+        # The index is ready: the views built from MPD are dropped
+        fake.library_index_id = 2
+        fake.library_index_valid = None
+        for name in ('library_index_get', 'library_views_reset'):
+            setattr(fake, name, functools.partial(
+                getattr(library.Library, name), fake))
+        fake.library_views_reset()
+        version = fake.library_views.version
+        browse_done(fake, 1, ('artist', wd, version), False, [], False,
+                    False, result)
+        self.assertIs(result, fake.library_views.get(('artist', wd)))
+        fake.library_index_valid = 2
+        library.Library.library_index_scanned(fake, 2, None)
+        self.assertIsNone(fake.library_views.get(('artist', wd)))
+
+
+class FakeListStore(list):
+    """The parts of Gtk.ListStore used to show the current playlist"""
+
+    def get_iter(self, path):
+        return path[0]
+
+    def get_value(self, i, column):
+        return self[i][column]
+
+    def set_value(self, i, column, value):
+        self[i][column] = value
+
+    def remove(self, i):
+        del self[i]
+
+
+class TestCurrent(unittest.TestCase):
+    def update(self, playlist, prevstatus_playlist, songs):
+        fake = unittest.mock.MagicMock()
+        fake.currentdata = playlist
+        fake.current_songs = [MPDSong({'id': row[0]}) for row in playlist]
+        fake.columnformat = []
+        fake.current_update_skip = fake.filterbox_visible = False
+        fake.songinfo.return_value = {}
+        songs = [MPDSong({'id': str(pos + 10), 'pos': str(pos),
+                          'file': name})
+                 for pos, name in enumerate(songs)]
+        with unittest.mock.patch('sonata.current.ui'):
+            current.Current.current_update_songs(
+                fake, prevstatus_playlist, str(len(songs)), '2', songs)
+        return fake
+
+    def test_resync(self):
+        # Full reloads, as on the first connection
+        fake = self.update(FakeListStore(), None, ['a', 'b'])
+        self.assertEqual(['a', 'b'], [s.file for s in fake.current_songs])
+        self.assertEqual([10, 11], [row[0] for row in fake.currentdata])
+        playlist = FakeListStore([[1, 0], [2, 0], [3, 0]])
+        fake = self.update(playlist, None, ['c', 'd'])
+        self.assertEqual(['c', 'd'], [s.file for s in fake.current_songs])
+        self.assertEqual([10, 11], [row[0] for row in fake.currentdata])
+
+
+    def test_fetch_error(self):
+        fake = unittest.mock.MagicMock()
+        fake.current_update_skip = False
+        fake.current_update_id = 0
+        fake.playlist_version = '5'
+        fake.mpd.iterate.side_effect = mpd.ConnectionError("Connection lost")
+        fake.mpd.run_async.side_effect = \
+                lambda func, *args, callback, purpose: callback(func(*args))
+        for name in ('current_fetch_changes', 'current_update_fetched'):
+            setattr(fake, name, functools.partial(
+                getattr(current.Current, name), fake))
+        with unittest.mock.patch('sonata.current.GLib') as glib:
+            current.Current.current_update(fake, '6', '2', '7')
+        # The changes are fetched again later, since the displayed playlist
+        fake.current_update_songs.assert_not_called()
+        glib.timeout_add_seconds.assert_called_once_with(
+            2, fake.current_update, '5', '2', '7')
+
+
 class TestMPDSong(unittest.TestCase):
     def test_get_track_number(self):
         self.assertEqual(1, MPDSong({'track': '1'}).track)
@@ -110,6 +341,420 @@ class TestMPDSong(unittest.TestCase):
         self.assertEqual('a', song.genre)
         self.assertEqual('c', song.foo)
 
+    def test_interned_tags(self):
+        album = ''.join(['al', 'bum'])
+        song1 = MPDSong({'album': 'album', 'last-modified': 'x'})
+        song2 = MPDSong({'album': album})
+        self.assertIs(song1.album, song2.album)
+        self.assertEqual('x', song1['last-modified'])
+        self.assertNotIn('last-modified', song2)
+        self.assertEqual({'album': 'album', 'last-modified': 'x'},
+                         dict(song1.items()))
+
+
+class FakeMPDClient:
+    """Answer 'count' commands, recording the command lists sent"""
+
+    def __init__(self):
+        self.command_lists = []
+        self._command_list = None
+
+    def command_list_ok_begin(self):
+        self._command_list = []
+
+    def command_list_end(self):
+        self.command_lists.append(self._command_list)
+        results = [{'playtime': len(arg), 'songs': 1}
+                   for _tag, arg in self._command_list]
+        self._command_list = None
+        return results
+
+    def stats(self):
+        return {'db_update': '1'}
+
+    def count(self, tag, arg):
+        if self._command_list is None:
+            return {'playtime': len(arg), 'songs': 1}
+        self._command_list.append((tag, arg))
+
+
+class QueueMPDClient(FakeMPDClient):
+    """Load playlists, failing in command lists like MPD does"""
+
+    def __init__(self):
+        super().__init__()
+        self.queue = []
+
+    def command_list_end(self):
+        commands, self._command_list = self._command_list, None
+        for i, name in enumerate(commands):
+            if name == 'missing':
+                raise mpd.CommandError(
+                    "[50@%d] {load} No such playlist" % i)
+            self.queue.append(name)
+        return [None] * len(commands)
+
+    def load(self, name):
+        if self._command_list is not None:
+            self._command_list.append(name)
+        elif name == 'missing':
+            raise mpd.CommandError("[50@0] {load} No such playlist")
+        else:
+            self.queue.append(name)
+
+
+class BlockingMPDClient(FakeMPDClient):
+    """Block on its socket when counting, like a hung server"""
+
+    def __init__(self):
+        super().__init__()
+        self.sock, self.peer = socket.socketpair()
+        self.blocked = threading.Event()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def count(self, tag, arg):
+        self.blocked.set()
+        if not self.sock.recv(1):
+            raise ConnectionResetError("Connection lost")
+
+    def disconnect(self):
+        pass
+
+
+class FakeIdleServer:
+    """Serve idle connections on a unix socket, running `script` for each
+    of them. The script is given a function reading the next command, and
+    one writing a response."""
+
+    def __init__(self, scripts):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'socket')
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self.serve, args=(scripts,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self, scripts):
+        for script in scripts:
+            conn, _addr = self.server.accept()
+            rfile = conn.makefile('r')
+            conn.sendall(b'OK MPD 0.23.0\n')
+            script(lambda: rfile.readline().split(' ')[0].strip(),
+                   lambda response: conn.sendall(response.encode()))
+            rfile.close()
+            conn.close()
+
+    def close(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+
+class TestMPDIdleListener(unittest.TestCase):
+    def test_reconnect(self):
+        done = threading.Event()
+        def first(read, write):
+            self.assertEqual('stats', read())
+            write('db_update: 1\nOK\n')
+            # Nothing happens: the listener leaves idle by itself
+            self.assertEqual('idle', read())
+            self.assertEqual('noidle', read())
+            write('OK\n')
+            self.assertEqual('idle', read())
+            write('changed: player\nOK\n')
+            # The connection is lost
+            self.assertEqual('idle', read())
+        def second(read, write):
+            self.assertEqual('stats', read())
+            write('db_update: 1\nOK\n')
+            self.assertEqual('idle', read())
+            done.set()
+            read()
+        server = FakeIdleServer([first, second])
+        notified = []
+        listener = MPDIdleListener(None)
+        listener.IDLE_TIMEOUT = 0.2
+        listener.RETRY_DELAY_MIN = 0
+        listener._notify = lambda stopped, changed: notified.append(changed)
+        listener.start(server.path, None, None)
+        self.assertTrue(done.wait(5))
+        listener.stop()
+        server.close()
+        # The database didn't change while disconnected
+        self.assertEqual([{'player'}, set(IDLE_SUBSYSTEMS) - {'database'}],
+                         notified)
+
+
+class SlowMPDClient(FakeMPDClient):
+    """Time out once the commands were sent, like a busy server"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def connect(self, host, port):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def ping(self):
+        self.sent.append('ping')
+
+    def next(self):
+        self.sent.append('next')
+        raise socket.timeout("timed out")
+
+    def status(self):
+        self.sent.append('status')
+        if self.sent.count('status') == 1:
+            raise socket.timeout("timed out")
+        return {'state': 'play'}
+
+
+class BrokenMPDClient(FakeMPDClient):
+    """Lose the connection in the middle of a response"""
+
+    iterate = False
+
+    def plchanges(self, version):
+        yield {'file': 'a', 'pos': '0'}
+        raise mpd.ConnectionError("Connection lost while reading line")
+
+    def disconnect(self):
+        pass
+
+
+class TestMPDClient(unittest.TestCase):
+    def test_batch(self):
+        fake = FakeMPDClient()
+        client = MPDClient(fake, max_connections=1)
+        with client.batch() as batch:
+            futures = [batch.count('artist', artist)
+                       for artist in ('a', 'bb', 'ccc')]
+        self.assertEqual([[('artist', 'a'), ('artist', 'bb'),
+                           ('artist', 'ccc')]], fake.command_lists)
+        self.assertEqual([1, 2, 3],
+                         [future.result().playtime for future in futures])
+        self.assertEqual(4, client.count('artist', 'dddd').playtime)
+
+    def test_batch_error(self):
+        fake = QueueMPDClient()
+        client = MPDClient(fake, max_connections=1)
+        with client.batch() as batch:
+            futures = [batch.load(name) for name in ('a', 'missing', 'b')]
+        self.assertEqual(['a', 'b'], fake.queue)
+        self.assertEqual([None, None, None],
+                         [future.result() for future in futures])
+
+    def test_timeout(self):
+        fake = SlowMPDClient()
+        client = MPDClient(fake, max_connections=1)
+        client.connect('localhost', 6600)
+        # Skipping a track twice would be worse than not at all
+        self.assertIsNone(client.next())
+        self.assertEqual(['next'], fake.sent)
+        self.assertEqual({'state': 'play'}, client.status())
+        self.assertEqual(['next', 'status', 'status'], fake.sent)
+        # Connections unused for a while are checked first
+        client._connections['control'].last_used -= 3600
+        client.next()
+        self.assertEqual(['next', 'status', 'status', 'ping', 'next'],
+                         fake.sent)
+
+    def test_version(self):
+        fake = SlowMPDClient()
+        fake.mpd_version = '0.21.3'
+        client = MPDClient(fake, max_connections=1)
+        self.assertEqual((0, 0, 0), client.version)
+        client.connect('localhost', 6600)
+        # python-mpd2 forgets it once the connection is lost
+        fake.mpd_version = None
+        self.assertEqual((0, 21, 3), client.version)
+        client.disconnect()
+        self.assertEqual((0, 0, 0), client.version)
+
+    def test_iterate_error(self):
+        client = MPDClient(BrokenMPDClient(), max_connections=1)
+        # The songs received so far aren't taken for the whole response
+        with self.assertRaises(mpd.ConnectionError):
+            list(client.iterate('plchanges', 0))
+        # From the worker too
+        with self.assertRaises(mpd.ConnectionError):
+            client.run_async(lambda: list(client.iterate('plchanges',
+                                                         0))).result(5)
+
+    def test_metrics(self):
+        metrics.reset()
+        client = MPDClient(FakeMPDClient(), max_connections=1)
+        client.count('artist', 'a')
+        client.count('artist', 'b')
+        self.assertEqual(2, metrics.commands['count'].calls)
+        self.assertEqual(0, metrics.commands['count'].errors)
+        self.assertEqual({'__init__.py:test_metrics': 2},
+                         dict(metrics.commands['count'].callers))
+        self.assertIn("count: 2 calls", metrics.dump())
+
+    def test_cache(self):
+        fake = FakeMPDClient()
+        client = MPDClient(fake, max_connections=1)
+        with client.batch() as batch:
+            batch.count('artist', 'a')
+        with client.batch() as batch:
+            cached = batch.count('artist', 'a')
+            batch.count('artist', 'b')
+        self.assertEqual(1, cached.result().playtime)
+        self.assertEqual([[('artist', 'a')], [('artist', 'b')]],
+                         fake.command_lists)
+        client.invalidate_cache()
+        client.count('artist', 'b')
+        self.assertEqual(2, len(fake.command_lists))
+
+    def test_worker_cancel_pending(self):
+        worker = MPDWorker("test worker")
+        started, release = threading.Event(), threading.Event()
+        ran = []
+        def block():
+            started.set()
+            release.wait(5)
+        running = worker.submit(block)
+        started.wait(5)
+        queued = worker.submit(ran.append, 'queued')
+        worker.cancel_pending()
+        release.set()
+        running.result(5)
+        self.assertTrue(queued.cancelled())
+        worker.submit(ran.append, 'after').result(5)
+        self.assertEqual(['after'], ran)
+
+    def test_disconnect_hung(self):
+        fake = BlockingMPDClient()
+        client = MPDClient(fake, max_connections=1)
+        future = client.call_async('count', 'artist', 'a')
+        fake.blocked.wait(5)
+        start = time.perf_counter()
+        client.disconnect()
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertIsNone(future.result(5))
+        fake.sock.close()
+        fake.peer.close()
+
+    def test_count_groups(self):
+        groups = MPDCount.groups({'artist': ['a', 'b'], 'songs': ['1', '2'],
+                                  'playtime': ['10', '20']}, 'artist')
+        self.assertEqual({'a': (10, 1), 'b': (20, 2)},
+                         {value: (count.playtime, count.songs)
+                          for value, count in groups.items()})
+        groups = MPDCount.groups({'artist': 'a', 'songs': '1',
+                                  'playtime': '10'}, 'Artist')
+        self.assertEqual(['a'], list(groups))
+        self.assertEqual({}, MPDCount.groups({}, 'artist'))
+
+    def test_filter_expression(self):
+        self.assertEqual('(artist == "a")',
+                         filter_expression([('artist', 'a')]))
+        self.assertEqual('((artist == "a \\"b\\"") AND (date == ""))',
+                         filter_expression([('artist', 'a "b"'),
+                                            ('date', '')]))
+        self.assertEqual('(album == "c:\\\\")',
+                         filter_expression([('album', 'c:\\')]))
+
+
+class TestLibraryIndex(unittest.TestCase):
+    def setUp(self):
+        songs = [{'file': 'a/1', 'artist': 'Foo', 'album': 'A', 'time': '10'},
+                 {'file': 'a/2', 'artist': 'foo', 'album': 'A', 'time': '20'},
+                 {'file': 'b/1', 'artist': 'Bar', 'album': 'B', 'time': '30',
+                  'genre': 'Rock'},
+                 {'file': 'c/1', 'time': '40'},
+                 {'directory': 'c'}]
+        self.index = LibraryIndex([MPDSong(s) for s in songs], '1',
+                                  'Untagged', 'Various Artists')
+
+    def test_list(self):
+        self.assertEqual(4, len(self.index))
+        self.assertEqual(['Bar', 'Foo'], self.index.list('artist'))
+        self.assertEqual(['Bar', 'Foo', 'foo'],
+                         self.index.list('artist', ignore_case=False))
+        self.assertEqual(['A'], self.index.list('album', artist='FOO'))
+        self.assertEqual(['c/1'], self.index.list('file', artist='Untagged'))
+
+    def test_casefold(self):
+        self.index.update([MPDSong({'file': 'e/1', 'artist': 'Straße'}),
+                           MPDSong({'file': 'e/2', 'artist': 'STRASSE'})])
+        self.assertEqual((0, 2), self.index.count(artist='strasse'))
+        self.assertEqual(1, len(self.index.list('artist', album='Untagged')))
+
+    def test_count(self):
+        self.assertEqual((30, 2), self.index.count(artist='foo', album='a'))
+        self.assertEqual((30, 2), self.index.count(artist='Various Artists',
+                                                   album='A'))
+        self.assertEqual((40, 1), self.index.count(genre='Untagged',
+                                                   album='Untagged'))
+        self.assertEqual((0, 0), self.index.count(artist='Baz'))
+        songs, playtime, num_songs = self.index.search(genre='rock')
+        self.assertEqual(['b/1'], [s.file for s in songs])
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'index')
+            self.index.save(filename)
+            index = LibraryIndex.load(filename, 'Untagged', 'Various Artists')
+        self.assertEqual('1', index.version)
+        self.assertEqual(self.index.songs, index.songs)
+        self.assertEqual((30, 2), index.count(artist='foo'))
+
+    def test_update(self):
+        self.index.update([MPDSong({'file': 'a/2', 'artist': 'Baz',
+                                    'album': 'A', 'time': '20'}),
+                           MPDSong({'file': 'd/1', 'artist': 'Bar',
+                                    'time': '50'})],
+                          removed=['b/1'], version='2')
+        self.assertEqual('2', self.index.version)
+        self.assertEqual(['a/1', 'a/2', 'c/1', 'd/1'],
+                         [song.file for song in self.index.songs])
+        self.assertEqual(['Bar', 'Baz', 'Foo'], self.index.list('artist'))
+        self.assertEqual((50, 1), self.index.count(artist='bar'))
+        self.assertEqual((0, 0), self.index.count(genre='Rock'))
+
+    def test_refresh(self):
+        fake = unittest.mock.MagicMock()
+        fake.mpd.listall.return_value = [{'file': s.file}
+                                         for s in self.index.songs]
+        refresh = library.Library.library_index_refresh
+        # A failed command leads to a full scan
+        fake.mpd.find.return_value = None
+        self.assertFalse(refresh(fake, self.index, {'songs': '4'}))
+        self.assertEqual(4, len(self.index))
+        fake.mpd.find.return_value = [{'file': 'c/1', 'artist': 'Baz'}]
+        self.assertTrue(refresh(fake, self.index, {'songs': '4'}))
+        self.assertEqual((0, 1), self.index.count(artist='baz'))
+        fake.mpd.listall.return_value = None
+        self.assertFalse(refresh(fake, self.index, {'songs': '4'}))
+
+    def test_find(self):
+        self.assertEqual(['a/1', 'a/2'],
+                         [song.file for song in self.index.find('artist',
+                                                                'FO')])
+        self.assertEqual(['b/1'], [song.file for song in
+                                   self.index.find('any', 'rock bar')])
+        self.assertEqual([], self.index.find('artist', 'rock'))
+        self.assertEqual([], self.index.find('any', 'xyz'))
+        self.index.update([MPDSong({'file': 'e/1', 'title': 'Straße'})])
+        self.assertEqual(['e/1'], [song.file for song in
+                                   self.index.find('title', 'STRASS')])
+
+    def test_find_ranked(self):
+        self.index.update([MPDSong({'file': 'e/1', 'artist': 'Foobar'}),
+                           MPDSong({'file': 'e/2', 'artist': 'The Foo'}),
+                           MPDSong({'file': 'e/3', 'artist': 'foo'})])
+        self.assertEqual(['a/1', 'a/2', 'e/3', 'e/1', 'e/2'],
+                         [song.file for song in self.index.find('artist',
+                                                                'foo')])
+
 
 def additional_tests():
     return unittest.TestSuite(